@@ -1,23 +1,126 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, Response, stream_with_context, send_from_directory, has_app_context, has_request_context
+import click
 import sqlite3
-from datetime import datetime
+import calendar
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import mimetypes
+import mmap
+import multiprocessing
+import queue
+import random
+import re
+import shutil
+import struct
+import threading
+import time
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 import os
 
+try:
+    import fcntl
+except ImportError:  # Windows ではワーカー間のロックなし（開発用サーバーのみ）
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow がなければアイコンの縮小版は作らない
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # brotli がなければ gzip のみ
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
 
-DATABASE = 'zaiko2.db'
+def _stores_from_env(value):
+    """「店舗ID=データベースのパス」をカンマ区切りで並べた設定を辞書にする"""
+    stores = {}
+    for entry in value.split(','):
+        if entry.strip():
+            store_id, _, database = entry.partition('=')
+            stores[store_id.strip()] = database.strip() or f'{store_id.strip()}.db'
+    return stores
+
+# データベース設定（環境変数 ZAIKO_DATABASE で上書き可能）
+app.config.update(
+    DATABASE=os.environ.get('ZAIKO_DATABASE', 'zaiko2.db'),
+    SQLITE_BUSY_TIMEOUT_MS=5000,        # ロック待ちの最大時間（ミリ秒）
+    SQLITE_SYNCHRONOUS='NORMAL',        # WAL と組み合わせて fsync 回数を削減
+    SQLITE_CACHE_SIZE_KB=16384,         # ページキャッシュ（KiB）
+    SQLITE_MMAP_SIZE=64 * 1024 * 1024,  # メモリマップ I/O のサイズ（バイト）
+    SQLITE_STATEMENT_CACHE=128,         # 接続ごとのプリペアドステートメントキャッシュ数
+    SQLITE_POOL_SIZE=4,                 # ワーカーごとに保持する接続数
+    SQLITE_WRITE_RETRIES=5,             # SQLITE_BUSY 時の再試行回数
+    SQLITE_RETRY_BACKOFF=0.05,          # 再試行の初回待ち時間（秒、毎回2倍）
+    SSE_ENABLED=os.environ.get('ZAIKO_SSE', '0') == '1',  # 1 にすると /events でプッシュ配信する（gthread ワーカーが必要）
+    INVENTORY_POLL_SECONDS=15,          # プッシュ配信しないとき、在庫一覧が /api/inventory?since= で変更を確認する間隔（秒）
+    SSE_POLL_INTERVAL=0.5,              # 変更を確認する間隔（秒）
+    SSE_QUEUE_SIZE=100,                 # 購読者ごとに溜めておくイベント数の上限
+    SSE_HEARTBEAT_SECONDS=15,           # 接続維持のコメントを送る間隔（秒）
+    SSE_MAX_SECONDS=300,                # 1本の接続の最大時間（ブラウザが自動で再接続する）
+    ICON_SIZES=(60, 120),               # カテゴリーアイコンの縮小サイズ（1x / 2x、px）
+    FORECAST_ALPHA=0.1,                 # 1日あたり使用量の指数移動平均の重み（大きいほど直近を重視）
+    FORECAST_LEAD_DAYS=7,               # 発注してから入荷するまでの日数
+    FORECAST_COVER_DAYS=14,             # 1回の発注でまかなう日数
+    SQL_SLOW_QUERY_MS=100,              # これより時間のかかった SQL 文をスロークエリログに書く
+    SLOW_QUERY_LOG='slow_queries.log',  # スロークエリログのファイル（空にすると書かない）
+    # ログインなしで /metrics を読めるアドレス（例: ZAIKO_METRICS_ALLOWED_ADDRS="127.0.0.1,::1"）
+    # 空なら店主のログインが必要。リバースプロキシの後ろでは全リクエストがプロキシのアドレスになるので設定しない
+    METRICS_ALLOWED_ADDRS=tuple(addr.strip() for addr in os.environ.get('ZAIKO_METRICS_ALLOWED_ADDRS', '').split(',')
+                                if addr.strip()),
+    ARCHIVE_DIR=os.environ.get('ZAIKO_ARCHIVE_DIR', ''),  # 履歴アーカイブの保存先（空ならデータベースの隣の archive/）
+    ARCHIVE_HORIZON_MONTHS=12,          # これより前の月の履歴をアーカイブする
+    # 複数店舗モード（例: ZAIKO_STORES="shibuya=stores/shibuya.db,ebisu=stores/ebisu.db"）
+    # 空なら従来どおり DATABASE の1店舗だけで動く
+    STORES=_stores_from_env(os.environ.get('ZAIKO_STORES', '')),
+    DB_CONNECTION_CACHE_SIZE=16,        # 全店舗で保持する接続数の上限（古い店舗の接続から閉じる）
+    DB_IDLE_SECONDS=300,                # これより長く使われなかった接続は閉じる（秒）
+    STORE_REPORT_WORKERS=8,             # 店舗横断レポートで同時に読む店舗数
+    JOB_RUNNER_ENABLED=os.environ.get('ZAIKO_JOB_RUNNER', '1') != '0',  # 0 にするとワーカー内でジョブを実行しない
+    JOB_WORKERS=2,                      # ワーカープロセスごとに同時に実行するジョブ数
+    JOB_POLL_INTERVAL=2.0,              # 実行待ちのジョブを確認する間隔（秒）
+    JOB_LEASE_SECONDS=300,              # 実行中のジョブの生存確認がこれより古ければ、落ちたとみなして再実行する
+    JOB_RETRY_BACKOFF=30,               # 失敗したジョブを再実行するまでの初回待ち時間（秒、毎回2倍）
+    JOB_HEARTBEAT_SECONDS=30,           # 実行中のジョブの生存確認と、応答のなくなったジョブの回収を行う間隔（秒）
+    JOB_RETENTION_DAYS=30,              # 終わったジョブと書き出したファイルを残す日数
+    JOB_OUTPUT_DIR=os.environ.get('ZAIKO_JOB_OUTPUT_DIR', ''),  # 書き出しファイルの保存先（空ならデータベースの隣の exports/）
+    TRASH_RETENTION_DAYS=30,            # ゴミ箱の品目をこれより長く置いたら整理（完全削除）の対象にする
+    PURGE_BATCH_SIZE=500,               # ゴミ箱の整理で1回のトランザクションで消す行数
+    PURGE_BATCH_PAUSE=0.01,             # 整理のトランザクションの間に空ける時間（秒、他の書き込みを先に通す）
+    VACUUM_STEP_PAGES=1000,             # incremental_vacuum で1回に切り詰めるページ数
+    JOB_SCHEDULE={                      # 毎日決まった時刻に登録する保守ジョブ（種類: 'HH:MM'）
+        'checkpoint_balances': '02:30',
+        'rebuild_rollup': '03:00',
+        'optimize': '03:30',
+    },
+)
 
 # データベース初期化関数
-def init_db():
+def init_db(database=None):
     """データベースが存在しない場合、テーブルを作成"""
-    if not os.path.exists(DATABASE):
+    database = database or app.config['DATABASE']
+    if not os.path.exists(database):
         print("データベースが見つかりません。新規作成します...")
-        conn = sqlite3.connect(DATABASE)
+        conn = sqlite3.connect(database)
         cursor = conn.cursor()
         
         cursor.executescript('''
+        -- 削除で空いたページを incremental_vacuum で切り詰められるようにする（テーブル作成前に設定が必要）
+        PRAGMA auto_vacuum = INCREMENTAL;
+        
         CREATE TABLE USERS (
             user_id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -96,21 +199,926 @@ def init_db():
         print("データベースの初期化が完了しました！")
     else:
         print("既存のデータベースを使用します。")
+    
+    migrate_db(database)
+
+# スキーママイグレーション
+# PRAGMA user_version に適用済みのバージョンを記録する。
+# 各要素が1つのバージョンで、SQL文字列または conn を受け取る関数のリスト。
+# 既存のマイグレーションは変更せず、必ず末尾に追加すること。
+MIGRATIONS = [
+    # 1: よく使うクエリ用のインデックス
+    [
+        # history() の並び替え・統計の期間絞り込み
+        'CREATE INDEX IF NOT EXISTS idx_stock_tx_created ON STOCK_TRANSACTIONS(created_at)',
+        # 品目ごとの履歴（item_id 単独のインデックスを置き換える）
+        'CREATE INDEX IF NOT EXISTS idx_stock_tx_item_created ON STOCK_TRANSACTIONS(item_id, created_at)',
+        'DROP INDEX IF EXISTS idx_stock_tx_item',
+        # index() のカテゴリー別一覧
+        'CREATE INDEX IF NOT EXISTS idx_items_active_category ON ITEMS(is_active, category_id, display_order)',
+        # 未解決の通知だけを対象にした部分インデックス
+        'CREATE INDEX IF NOT EXISTS idx_notifications_unresolved_item ON NOTIFICATIONS(item_id) WHERE is_resolved = 0',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_unresolved_time ON NOTIFICATIONS(triggered_at) WHERE is_resolved = 0',
+        'DROP INDEX IF EXISTS idx_notifications_resolved',
+    ],
+    # 2: 日別集計テーブル（統計画面用）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS STOCK_DAILY_ROLLUP (
+            day TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            received REAL NOT NULL DEFAULT 0,
+            used REAL NOT NULL DEFAULT 0,
+            removed REAL NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            usage_tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, item_id)
+        ) WITHOUT ROWID
+        ''',
+        lambda conn: rebuild_daily_rollup(conn),
+    ],
+    # 3: 履歴の絞り込み用インデックス（created_at の後ろに暗黙の tx_id が付く）
+    [
+        'CREATE INDEX IF NOT EXISTS idx_stock_tx_user_created ON STOCK_TRANSACTIONS(user_id, created_at)',
+        'DROP INDEX IF EXISTS idx_stock_tx_user',
+        'CREATE INDEX IF NOT EXISTS idx_stock_tx_reason_created ON STOCK_TRANSACTIONS(reason, created_at)',
+    ],
+    # 4: 差分取得用の変更番号（品目・通知が変わるたびにトリガーで採番）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS CHANGE_SEQ (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'INSERT OR IGNORE INTO CHANGE_SEQ (id, seq) VALUES (1, 0)',
+        'ALTER TABLE ITEMS ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE NOTIFICATIONS ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_items_change_seq ON ITEMS(change_seq)',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_change_seq ON NOTIFICATIONS(change_seq)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_change_insert AFTER INSERT ON ITEMS
+        BEGIN
+            UPDATE CHANGE_SEQ SET seq = seq + 1 WHERE id = 1;
+            UPDATE ITEMS SET change_seq = (SELECT seq FROM CHANGE_SEQ WHERE id = 1) WHERE item_id = NEW.item_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_change_update
+        AFTER UPDATE OF name, unit, current_quantity, min_threshold, supplier_id, category_id, is_active, display_order ON ITEMS
+        BEGIN
+            UPDATE CHANGE_SEQ SET seq = seq + 1 WHERE id = 1;
+            UPDATE ITEMS SET change_seq = (SELECT seq FROM CHANGE_SEQ WHERE id = 1) WHERE item_id = NEW.item_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_change_insert AFTER INSERT ON NOTIFICATIONS
+        BEGIN
+            UPDATE CHANGE_SEQ SET seq = seq + 1 WHERE id = 1;
+            UPDATE NOTIFICATIONS SET change_seq = (SELECT seq FROM CHANGE_SEQ WHERE id = 1)
+            WHERE notification_id = NEW.notification_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_change_update AFTER UPDATE OF is_resolved ON NOTIFICATIONS
+        BEGIN
+            UPDATE CHANGE_SEQ SET seq = seq + 1 WHERE id = 1;
+            UPDATE NOTIFICATIONS SET change_seq = (SELECT seq FROM CHANGE_SEQ WHERE id = 1)
+            WHERE notification_id = NEW.notification_id;
+        END
+        ''',
+    ],
+    # 5: 在庫不足の通知をトリガーで開閉する
+    # 有効な品目の在庫が閾値を下回ったら通知を作成し、閾値以上に戻ったら（または削除されたら）解決する
+    [
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_low_stock_insert AFTER INSERT ON ITEMS
+        WHEN NEW.is_active = 1 AND NEW.current_quantity < NEW.min_threshold
+        BEGIN
+            INSERT INTO NOTIFICATIONS (item_id, type, threshold_at_time, quantity_at_time)
+            VALUES (NEW.item_id, 'low_stock', NEW.min_threshold, NEW.current_quantity);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_low_stock_open
+        AFTER UPDATE OF current_quantity, min_threshold, is_active ON ITEMS
+        WHEN NEW.is_active = 1 AND NEW.current_quantity < NEW.min_threshold
+        AND NOT (OLD.is_active = 1 AND OLD.current_quantity < OLD.min_threshold)
+        BEGIN
+            INSERT INTO NOTIFICATIONS (item_id, type, threshold_at_time, quantity_at_time)
+            SELECT NEW.item_id, 'low_stock', NEW.min_threshold, NEW.current_quantity
+            WHERE NOT EXISTS (
+                SELECT 1 FROM NOTIFICATIONS WHERE item_id = NEW.item_id AND is_resolved = 0
+            );
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_low_stock_resolve
+        AFTER UPDATE OF current_quantity, min_threshold, is_active ON ITEMS
+        WHEN OLD.is_active = 1 AND OLD.current_quantity < OLD.min_threshold
+        AND NOT (NEW.is_active = 1 AND NEW.current_quantity < NEW.min_threshold)
+        BEGIN
+            UPDATE NOTIFICATIONS SET is_resolved = 1 WHERE item_id = NEW.item_id AND is_resolved = 0;
+        END
+        ''',
+        # 既に補充済み・削除済みの品目に残っている通知を解決しておく
+        '''
+        UPDATE NOTIFICATIONS SET is_resolved = 1
+        WHERE is_resolved = 0 AND item_id IN (
+            SELECT item_id FROM ITEMS WHERE NOT (is_active = 1 AND current_quantity < min_threshold)
+        )
+        ''',
+    ],
+    # 6: 品目ごとの使用ペース（在庫切れ予測用）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ITEM_FORECAST (
+            item_id INTEGER PRIMARY KEY,
+            rate REAL,
+            day TEXT NOT NULL,
+            day_used REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        lambda conn: rebuild_item_forecast(conn),
+    ],
+    # 7: 履歴のアーカイブ（月ごとの別ファイル）と品目ごとの残高スナップショット
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ARCHIVED_MONTHS (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            tx_count INTEGER NOT NULL,
+            last_tx_id INTEGER NOT NULL,
+            archived_at TEXT DEFAULT (datetime('now', 'localtime'))
+        )
+        ''',
+        # quantity は tx_id までの履歴（アーカイブ済みを含む）の合計
+        '''
+        CREATE TABLE IF NOT EXISTS ITEM_BALANCE_SNAPSHOTS (
+            item_id INTEGER NOT NULL,
+            tx_id INTEGER NOT NULL,
+            quantity REAL NOT NULL,
+            created_at TEXT DEFAULT (datetime('now', 'localtime')),
+            PRIMARY KEY (item_id, tx_id)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 8: 残高のチェックポイント（全品目の残高を ITEM_BALANCE_SNAPSHOTS に記録した tx_id）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS BALANCE_CHECKPOINTS (
+            checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_id INTEGER NOT NULL,
+            item_count INTEGER NOT NULL,
+            created_at TEXT DEFAULT (datetime('now', 'localtime'))
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_balance_checkpoints_tx ON BALANCE_CHECKPOINTS(tx_id)',
+    ],
+    # 9: バックグラウンドジョブ（status: queued / running / done / failed）
+    # schedule_key は定期ジョブの「種類@日付」。一意にして複数ワーカーからの二重登録を防ぐ
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS JOBS (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+            schedule_key TEXT UNIQUE,
+            created_by INTEGER,
+            created_at TEXT DEFAULT (datetime('now', 'localtime')),
+            started_at TEXT,
+            heartbeat_at TEXT,
+            finished_at TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON JOBS(status, run_after)',
+    ],
+    # 10: 品目の全文検索（trigram なので日本語でも3文字以上の部分一致が索引で引ける）
+    # rowid は item_id。在庫数の更新では発火しないよう、検索に使う列の変更だけで作り直す
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ITEM_SEARCH USING fts5(
+            name, unit, supplier_name, category_name,
+            tokenize = 'trigram'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_insert AFTER INSERT ON ITEMS
+        BEGIN
+            INSERT INTO ITEM_SEARCH (rowid, name, unit, supplier_name, category_name)
+            VALUES (NEW.item_id, NEW.name, NEW.unit,
+                    (SELECT name FROM SUPPLIERS WHERE supplier_id = NEW.supplier_id),
+                    (SELECT name FROM CATEGORIES WHERE category_id = NEW.category_id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_update
+        AFTER UPDATE OF name, unit, supplier_id, category_id ON ITEMS
+        BEGIN
+            DELETE FROM ITEM_SEARCH WHERE rowid = OLD.item_id;
+            INSERT INTO ITEM_SEARCH (rowid, name, unit, supplier_name, category_name)
+            VALUES (NEW.item_id, NEW.name, NEW.unit,
+                    (SELECT name FROM SUPPLIERS WHERE supplier_id = NEW.supplier_id),
+                    (SELECT name FROM CATEGORIES WHERE category_id = NEW.category_id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_delete AFTER DELETE ON ITEMS
+        BEGIN
+            DELETE FROM ITEM_SEARCH WHERE rowid = OLD.item_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_supplier_update AFTER UPDATE OF name ON SUPPLIERS
+        BEGIN
+            UPDATE ITEM_SEARCH SET supplier_name = NEW.name
+            WHERE rowid IN (SELECT item_id FROM ITEMS WHERE supplier_id = NEW.supplier_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_supplier_delete AFTER DELETE ON SUPPLIERS
+        BEGIN
+            UPDATE ITEM_SEARCH SET supplier_name = NULL
+            WHERE rowid IN (SELECT item_id FROM ITEMS WHERE supplier_id = OLD.supplier_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_category_update AFTER UPDATE OF name ON CATEGORIES
+        BEGIN
+            UPDATE ITEM_SEARCH SET category_name = NEW.name
+            WHERE rowid IN (SELECT item_id FROM ITEMS WHERE category_id = NEW.category_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_category_delete AFTER DELETE ON CATEGORIES
+        BEGIN
+            UPDATE ITEM_SEARCH SET category_name = NULL
+            WHERE rowid IN (SELECT item_id FROM ITEMS WHERE category_id = OLD.category_id);
+        END
+        ''',
+        '''
+        INSERT INTO ITEM_SEARCH (rowid, name, unit, supplier_name, category_name)
+        SELECT i.item_id, i.name, i.unit, s.name, c.name
+        FROM ITEMS i
+        LEFT JOIN SUPPLIERS s ON i.supplier_id = s.supplier_id
+        LEFT JOIN CATEGORIES c ON i.category_id = c.category_id
+        ''',
+    ],
+    # 11: 完全に削除した品目の変更番号（差分取得で削除を伝えるため）
+    # 同じ item_id で品目が作り直されたら消す
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ITEM_TOMBSTONES (
+            item_id INTEGER PRIMARY KEY,
+            change_seq INTEGER NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_item_tombstones_change_seq ON ITEM_TOMBSTONES(change_seq)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_change_delete AFTER DELETE ON ITEMS
+        BEGIN
+            UPDATE CHANGE_SEQ SET seq = seq + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO ITEM_TOMBSTONES (item_id, change_seq)
+            VALUES (OLD.item_id, (SELECT seq FROM CHANGE_SEQ WHERE id = 1));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_item_tombstones_reuse AFTER INSERT ON ITEMS
+        BEGIN
+            DELETE FROM ITEM_TOMBSTONES WHERE item_id = NEW.item_id;
+        END
+        ''',
+    ],
+    # 12: ゴミ箱に入れた日時（ゴミ箱の整理はこの日時から数える）
+    # 既にゴミ箱にある品目は、いつ入れたか分からないのでマイグレーションした時点から数える
+    [
+        'ALTER TABLE ITEMS ADD COLUMN trashed_at TEXT',
+        "UPDATE ITEMS SET trashed_at = datetime('now', 'localtime') WHERE is_active IN (0, -1)",
+    ],
+]
 
-# アプリ起動時にデータベースを初期化
-init_db()
+# 日別集計（STOCK_DAILY_ROLLUP）
+# received: 入荷などプラスの合計 / used: 使用・廃棄による減少量 /
+# removed: 理由を問わないマイナスの合計 / usage_tx_count: 使用・廃棄の回数
+USAGE_REASONS = ('使用', '廃棄')
 
-# データベース接続
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+ROLLUP_COLUMNS = f'''
+    date(created_at),
+    item_id,
+    SUM(MAX(quantity_delta, 0)),
+    SUM(CASE WHEN reason IN {USAGE_REASONS} AND quantity_delta < 0 THEN -quantity_delta ELSE 0 END),
+    SUM(MAX(-quantity_delta, 0)),
+    COUNT(*),
+    SUM(reason IN {USAGE_REASONS})
+'''
+
+ROLLUP_UPSERT = f'''
+    INSERT INTO STOCK_DAILY_ROLLUP (day, item_id, received, used, removed, tx_count, usage_tx_count)
+    SELECT {ROLLUP_COLUMNS}
+    FROM STOCK_TRANSACTIONS
+    WHERE tx_id BETWEEN ? AND ?
+    GROUP BY date(created_at), item_id
+    ON CONFLICT (day, item_id) DO UPDATE SET
+        received = received + excluded.received,
+        used = used + excluded.used,
+        removed = removed + excluded.removed,
+        tx_count = tx_count + excluded.tx_count,
+        usage_tx_count = usage_tx_count + excluded.usage_tx_count
+'''
+
+def record_daily_rollup(conn, first_tx_id, last_tx_id=None):
+    """取引（first_tx_id〜last_tx_id）を日別集計に反映する（取引と同じトランザクション内で呼ぶこと）"""
+    if last_tx_id is None:
+        last_tx_id = first_tx_id
+    conn.execute(ROLLUP_UPSERT, (first_tx_id, last_tx_id))
+
+def rebuild_daily_rollup(conn):
+    """履歴全体から日別集計を作り直す（アーカイブ済みの月の集計は残す）"""
+    conn.execute('''
+        DELETE FROM STOCK_DAILY_ROLLUP
+        WHERE day >= COALESCE((SELECT date(MIN(created_at)) FROM STOCK_TRANSACTIONS), '9999-12-31')
+    ''')
+    conn.execute(f'''
+        INSERT INTO STOCK_DAILY_ROLLUP (day, item_id, received, used, removed, tx_count, usage_tx_count)
+        SELECT {ROLLUP_COLUMNS}
+        FROM STOCK_TRANSACTIONS
+        GROUP BY date(created_at), item_id
+    ''')
+
+# 使用ペースの予測（ITEM_FORECAST）
+# 1日あたりの使用量（使用・廃棄）の指数移動平均（EWMA）を品目ごとに持つ。
+# rate は day の前日までの平均（まだ1日分もなければ NULL）、day_used は day 当日の使用量。
+# 使用のない日は使用量 0 の日として扱い、日数分まとめて減衰させる。
+def advance_forecast(rate, day, day_used, to_day, alpha):
+    """day 当日の使用量と to_day の前日までの使用のない日を rate に反映する"""
+    gap = (to_day - day).days
+    if gap <= 0:
+        return rate
+    rate = day_used if rate is None else alpha * day_used + (1 - alpha) * rate
+    return rate * (1 - alpha) ** (gap - 1)
+
+def rebuild_item_forecast(conn):
+    """日別集計全体から使用ペースを作り直す（品目順に1回だけ読む）"""
+    alpha = app.config['FORECAST_ALPHA']
+    states = {}
+    for item_id, day, used in conn.execute('''
+        SELECT item_id, day, used FROM STOCK_DAILY_ROLLUP
+        WHERE used > 0
+        ORDER BY item_id, day
+    '''):
+        day = date.fromisoformat(day)
+        state = states.get(item_id)
+        if state is None:
+            states[item_id] = (None, day, used)
+        else:
+            states[item_id] = (advance_forecast(*state, day, alpha), day, used)
+    
+    conn.execute('DELETE FROM ITEM_FORECAST')
+    conn.executemany('INSERT INTO ITEM_FORECAST (item_id, rate, day, day_used) VALUES (?, ?, ?, ?)',
+                     [(item_id, rate, day.isoformat(), day_used)
+                      for item_id, (rate, day, day_used) in states.items()])
+
+def record_usage_forecast(conn, usages, today=None):
+    """使用・廃棄の取引 [(item_id, 使用量), ...] を使用ペースに反映する（取引と同じトランザクション内で呼ぶこと）"""
+    today = today or date.today()
+    totals = {}
+    for item_id, used in usages:
+        totals[item_id] = totals.get(item_id, 0) + used
+    if not totals:
+        return
+    
+    alpha = app.config['FORECAST_ALPHA']
+    states = {row[0]: (row[1], date.fromisoformat(row[2]), row[3]) for row in conn.execute(
+        'SELECT item_id, rate, day, day_used FROM ITEM_FORECAST WHERE item_id IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(totals)),))}
+    
+    params = []
+    for item_id, used in totals.items():
+        rate, day, day_used = states.get(item_id, (None, today, 0))
+        if day >= today:
+            params.append((item_id, rate, day.isoformat(), day_used + used))
+        else:
+            params.append((item_id, advance_forecast(rate, day, day_used, today, alpha), today.isoformat(), used))
+    conn.executemany('''
+        INSERT INTO ITEM_FORECAST (item_id, rate, day, day_used) VALUES (?, ?, ?, ?)
+        ON CONFLICT (item_id) DO UPDATE SET rate = excluded.rate, day = excluded.day, day_used = excluded.day_used
+    ''', params)
+
+def item_forecast(current_quantity, min_threshold, rate, day, day_used, today):
+    """1日あたりの使用量・在庫切れまでの日数・発注量の目安を返す（使用履歴がなければ None）"""
+    if day is None:
+        return None
+    day = date.fromisoformat(day)
+    if day < today:
+        rate = advance_forecast(rate, day, day_used, today, app.config['FORECAST_ALPHA'])
+    elif rate is None:
+        rate = day_used  # 使い始めた当日は当日分だけで見積もる
+    if not rate or rate < 1e-9:
+        return None
+    
+    target = rate * (app.config['FORECAST_LEAD_DAYS'] + app.config['FORECAST_COVER_DAYS']) + min_threshold
+    return {
+        'daily_usage': round(rate, 2),
+        'days_until_stockout': max(current_quantity, 0) / rate,
+        'reorder_quantity': max(math.ceil(target - current_quantity), 0),
+    }
+
+def migrate_db(database=None):
+    """未適用のマイグレーションを順番に適用する"""
+    conn = sqlite3.connect(database or app.config['DATABASE'],
+                           timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+                           isolation_level=None)
+    try:
+        for version, steps in enumerate(MIGRATIONS, start=1):
+            # 複数ワーカーが同時に起動しても二重に適用しないよう書き込みロックを取ってから確認
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current >= version:
+                conn.execute('ROLLBACK')
+                continue
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            print(f"マイグレーション {version} を適用しました")
+        conn.execute('PRAGMA optimize')
+    finally:
+        conn.close()
+
+# 店舗の切り替え（複数店舗モード）
+# 店舗ごとに別のデータベースファイルを使う。リクエストの店舗は
+# URL の先頭（/shibuya/...）→ サブドメイン（shibuya.example.com）→ セッション → 最初の店舗 の順に決める。
+# データベースの作成とマイグレーションは、その店舗に初めて接続するときに行う。
+_ready_databases = set()
+_ready_lock = threading.Lock()
+
+def ensure_database(database):
+    """初めて使うデータベースなら作成・マイグレーションする"""
+    if database in _ready_databases:
+        return
+    with _ready_lock:
+        if database not in _ready_databases:
+            directory = os.path.dirname(os.path.abspath(database))
+            os.makedirs(directory, exist_ok=True)
+            init_db(database)
+            _ready_databases.add(database)
+
+class StoreDispatcher:
+    """URL の先頭またはサブドメインから店舗を決めて environ['zaiko.store'] に入れる。
+    URL の店舗部分は SCRIPT_NAME に移すので、url_for で作るリンクにも店舗が付く。"""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        stores = app.config['STORES']
+        if stores:
+            store, _, rest = environ.get('PATH_INFO', '').lstrip('/').partition('/')
+            if store in stores:
+                environ['zaiko.script_root'] = environ.get('SCRIPT_NAME', '').rstrip('/')
+                environ['SCRIPT_NAME'] = environ['zaiko.script_root'] + '/' + store
+                environ['PATH_INFO'] = '/' + rest
+                environ['zaiko.store'] = store
+            else:
+                host = environ.get('HTTP_HOST', '').split(':')[0]
+                subdomain = host.split('.')[0]
+                if '.' in host and subdomain in stores:
+                    environ['zaiko.store'] = subdomain
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = StoreDispatcher(app.wsgi_app)
+
+def requested_store():
+    """URL またはサブドメインで指定された店舗（指定がなければ None）"""
+    return request.environ.get('zaiko.store') if has_request_context() else None
+
+def current_store():
+    """このリクエストの店舗 ID（単一店舗モードやリクエスト外では None）"""
+    stores = app.config['STORES']
+    if not stores or not has_request_context():
+        return None
+    store = requested_store() or session.get('store_id')
+    return store if store in stores else next(iter(stores))
+
+_job_local = threading.local()  # バックグラウンドジョブの実行中はその店舗のデータベース
+
+def current_database():
+    """このリクエスト（またはジョブ）で使うデータベースファイル（CLI などでは DATABASE）"""
+    store = current_store()
+    if store is not None:
+        return app.config['STORES'][store]
+    return getattr(_job_local, 'database', None) or app.config['DATABASE']
+
+@app.template_global()
+def store_url(store_id):
+    """指定した店舗の在庫一覧の URL（URL の先頭で店舗を選ぶ形）"""
+    root = request.environ.get('zaiko.script_root', request.script_root.rstrip('/'))
+    return f'{root}/{store_id}/'
+
+@app.context_processor
+def inject_store():
+    return {'current_store': current_store(), 'stores': app.config['STORES']}
+
+# 単一店舗モードでは従来どおり起動時にデータベースを初期化する
+if not app.config['STORES']:
+    ensure_database(app.config['DATABASE'])
+
+# SQL の計測
+# リクエスト中に実行した SQL 文の数と時間を g.sql_stats に記録する。
+# 時間は execute() と行の取り出し（fetch / for 文）の合計で、1文ずつ記録する。
+class InstrumentedCursor(sqlite3.Cursor):
+    _entry = None
+    
+    def _start(self, sql, parameters):
+        stats = g.get('sql_stats') if has_app_context() else None
+        if stats is None:
+            self._entry = None
+            return
+        self._entry = [sql, parameters, 0.0]
+        stats['statements'].append(self._entry)
+    
+    def _timed(self, method, *args):
+        if self._entry is None:
+            return method(*args)
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._entry[2] += time.perf_counter() - started
+    
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._start(sql, seq_of_parameters[0] if seq_of_parameters else ())
+        return self._timed(super().executemany, sql, seq_of_parameters)
+    
+    def fetchone(self):
+        return self._timed(super().fetchone)
+    
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, size or self.arraysize)
+    
+    def fetchall(self):
+        return self._timed(super().fetchall)
+    
+    def __next__(self):
+        return self._timed(super().__next__)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# データベース接続プール（ワーカープロセスごと）
+# データベース（店舗）ごとの空き接続を、最近使った順に並べて持つ。
+# 全体で DB_CONNECTION_CACHE_SIZE を超えたら最も長く使われていない店舗の接続から閉じ、
+# DB_IDLE_SECONDS より長く使われていない接続も閉じる。
+_db_pools = OrderedDict()  # データベース → [(接続, プールに戻した時刻), ...]（古い順）
+_db_pool_lock = threading.Lock()
+
+def _connect(database=None):
+    """設定に従ってチューニング済みの接続を新しく開く"""
+    database = database or current_database()
+    ensure_database(database)
+    conn = sqlite3.connect(
+        database,
+        timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        cached_statements=app.config['SQLITE_STATEMENT_CACHE'],
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    conn.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_SIZE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.database = database
     return conn
 
+def _evict_connections(now):
+    """上限を超えた分と使われていない接続をプールから外して返す（_db_pool_lock を持って呼ぶ）"""
+    evicted = []
+    total = sum(len(pool) for pool in _db_pools.values())
+    idle_since = now - app.config['DB_IDLE_SECONDS']
+    for database in list(_db_pools):  # 最も長く使われていない店舗から
+        pool = _db_pools[database]
+        while pool and (total > app.config['DB_CONNECTION_CACHE_SIZE'] or pool[0][1] < idle_since):
+            evicted.append(pool.pop(0)[0])
+            total -= 1
+        if not pool:
+            del _db_pools[database]
+    return evicted
+
+def _acquire_connection(database=None):
+    database = database or current_database()
+    conn = None
+    with _db_pool_lock:
+        pool = _db_pools.get(database)
+        if pool:
+            _db_pools.move_to_end(database)
+            conn = pool.pop()[0]
+        evicted = _evict_connections(time.monotonic())
+    for stale in evicted:
+        stale.close()
+    return conn if conn is not None else _connect(database)
+
+def _release_connection(conn):
+    # 途中で例外が起きた場合などに残ったトランザクションは破棄する
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    now = time.monotonic()
+    with _db_pool_lock:
+        pool = _db_pools.setdefault(conn.database, [])
+        _db_pools.move_to_end(conn.database)
+        evicted = [] if len(pool) < app.config['SQLITE_POOL_SIZE'] else [conn]
+        if not evicted:
+            pool.append((conn, now))
+        evicted.extend(_evict_connections(now))
+    for stale in evicted:
+        stale.close()
+
+def pooled_connection_count():
+    with _db_pool_lock:
+        return sum(len(pool) for pool in _db_pools.values())
+
+def _use_only_connection(conn):
+    """プールを指定の接続1本だけにする（benchmark / check-query-plans の記録用）"""
+    with _db_pool_lock:
+        evicted = [pooled for pool in _db_pools.values() for pooled, _ in pool]
+        _db_pools.clear()
+        _db_pools[conn.database] = [(conn, time.monotonic())]
+    for stale in evicted:
+        stale.close()
+
+def forget_database(database):
+    """database のプールの接続を閉じ、次に使うときに作成・マイグレーションし直させる（ファイルを消したとき用）"""
+    path = os.path.abspath(database)
+    with _db_pool_lock:
+        evicted = []
+        for key in [key for key in _db_pools if os.path.abspath(key) == path]:
+            evicted.extend(pooled for pooled, _ in _db_pools.pop(key))
+    for stale in evicted:
+        stale.close()
+    with _ready_lock:
+        _ready_databases.difference_update({key for key in _ready_databases if os.path.abspath(key) == path})
+
+# データベース接続（リクエスト内では同じ接続を使い回す）
+def get_db():
+    if 'db' not in g:
+        g.db = _acquire_connection()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _release_connection(conn)
+
+# リクエストの計測（Server-Timing ヘッダー・スロークエリログ・/metrics）
+# 集計はワーカープロセスごと。gunicorn で複数ワーカーを動かす場合は、応答したワーカーの値になる。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    'requests': {},      # (endpoint, method, status) → 件数
+    'latency': {},       # endpoint → [バケットごとの件数..., 合計秒, 件数]
+    'sql_queries': {},   # endpoint → SQL 文の数
+    'sql_seconds': {},   # endpoint → SQL の合計秒
+    'slow_queries': 0,
+}
+
+slow_query_logger = logging.getLogger('zaiko.slow_query')
+
+def _slow_query_log():
+    if not slow_query_logger.handlers and app.config['SLOW_QUERY_LOG']:
+        handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'], encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.setLevel(logging.INFO)
+        slow_query_logger.propagate = False
+    return slow_query_logger
+
+def log_slow_queries(conn, endpoint, statements):
+    """時間のかかった SQL 文をクエリプランと一緒にログに書き、件数を返す"""
+    threshold = app.config['SQL_SLOW_QUERY_MS'] / 1000
+    slow = [entry for entry in statements if entry[2] >= threshold]
+    if not slow or not app.config['SLOW_QUERY_LOG']:
+        return len(slow)
+    
+    logger = _slow_query_log()
+    for sql, parameters, seconds in slow:
+        lines = [f'{endpoint} {seconds * 1000:.1f}ms {" ".join(sql.split())} {parameters!r}']
+        try:
+            # 計測しないカーソルでクエリプランを取る
+            for row in sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters):
+                lines.append(f'    {row[3]}')
+        except sqlite3.Error as e:
+            lines.append(f'    (クエリプランを取得できません: {e})')
+        logger.info('\n'.join(lines))
+    return len(slow)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_stats = {'statements': []}
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    stats = g.get('sql_stats')
+    if started is None or stats is None:
+        return response
+    elapsed = time.perf_counter() - started
+    statements = stats['statements']
+    sql_seconds = sum(entry[2] for entry in statements)
+    endpoint = request.endpoint or 'unknown'
+    
+    slow = log_slow_queries(g.db, endpoint, statements) if 'db' in g else 0
+    response.headers['Server-Timing'] = (f'sql;dur={sql_seconds * 1000:.2f};desc="{len(statements)} queries", '
+                                         f'app;dur={elapsed * 1000:.2f}')
+    
+    with _metrics_lock:
+        key = (endpoint, request.method, response.status_code)
+        _metrics['requests'][key] = _metrics['requests'].get(key, 0) + 1
+        histogram = _metrics['latency'].setdefault(endpoint, [0] * len(LATENCY_BUCKETS) + [0.0, 0])
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                histogram[index] += 1
+        histogram[-2] += elapsed
+        histogram[-1] += 1
+        _metrics['sql_queries'][endpoint] = _metrics['sql_queries'].get(endpoint, 0) + len(statements)
+        _metrics['sql_seconds'][endpoint] = _metrics['sql_seconds'].get(endpoint, 0.0) + sql_seconds
+        _metrics['slow_queries'] += slow
+    
+    # ストリーミングの応答で後から実行される SQL は数えない
+    g.sql_stats = None
+    return response
+
+def render_metrics():
+    """計測値を Prometheus のテキスト形式にする"""
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    
+    with _metrics_lock:
+        metric('zaiko_http_requests_total', 'counter', 'Number of HTTP requests.',
+               [({'endpoint': endpoint, 'method': method, 'status': status}, count)
+                for (endpoint, method, status), count in sorted(_metrics['requests'].items())])
+        lines.append('# HELP zaiko_http_request_duration_seconds Time to build the response.')
+        lines.append('# TYPE zaiko_http_request_duration_seconds histogram')
+        for endpoint, histogram in sorted(_metrics['latency'].items()):
+            name = 'zaiko_http_request_duration_seconds'
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram[-1]}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram[-2]:.6f}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram[-1]}')
+        metric('zaiko_sql_queries_total', 'counter', 'SQL statements executed during requests.',
+               [({'endpoint': endpoint}, count) for endpoint, count in sorted(_metrics['sql_queries'].items())])
+        metric('zaiko_sql_duration_seconds_total', 'counter', 'Time spent in SQL during requests.',
+               [({'endpoint': endpoint}, f'{seconds:.6f}') for endpoint, seconds in sorted(_metrics['sql_seconds'].items())])
+        metric('zaiko_slow_queries_total', 'counter', 'SQL statements slower than SQL_SLOW_QUERY_MS.',
+               [({}, _metrics['slow_queries'])])
+    
+    cache = statistics_cache.stats()
+    metric('zaiko_statistics_cache_entries', 'gauge', 'Entries in the statistics cache.', [({}, cache['entries'])])
+    for name in ('hits', 'misses', 'evictions'):
+        metric(f'zaiko_statistics_cache_{name}_total', 'counter', f'Statistics cache {name}.', [({}, cache[name])])
+    pooled = pooled_connection_count()
+    metric('zaiko_db_pool_connections', 'gauge', 'Idle pooled SQLite connections.', [({}, pooled)])
+    metric('zaiko_data_version', 'gauge', 'Shared data version counter.', [({}, data_version())])
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus などの収集用。許可したアドレス以外からは店主のログインが必要
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRS'] and session.get('role') != 'owner':
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# 書き込みトランザクション
+# BEGIN IMMEDIATE で最初から書き込みロックを取り、ロック昇格時のデッドロックを避ける。
+# busy_timeout を超えて SQLITE_BUSY になった場合は待ち時間を延ばしながら再試行する。
+def _is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+def write_transaction(conn, work):
+    """work(conn) を1つの書き込みトランザクションとして実行し、その戻り値を返す"""
+    retries = app.config['SQLITE_WRITE_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = work(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not _is_busy(e) or attempt == retries:
+                raise
+            delay = app.config['SQLITE_RETRY_BACKOFF'] * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+# データバージョン
+# 書き込みのたびに増えるカウンター。データベースの隣の小さなファイルを mmap して
+# 同じホストの全ワーカーで共有するので、読み取りに SQL もシステムコールも要らない。
+_version_maps = {}
+_version_lock = threading.Lock()
+
+def _version_map(database=None):
+    path = (database or current_database()) + '.version'
+    mm = _version_maps.get(path)
+    if mm is None:
+        with _version_lock:
+            mm = _version_maps.get(path)
+            if mm is None:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if os.fstat(fd).st_size < 8:
+                        os.ftruncate(fd, 8)
+                    mm = mmap.mmap(fd, 8)
+                finally:
+                    os.close(fd)
+                _version_maps[path] = mm
+    return mm
+
+def data_version(database=None):
+    """現在のデータバージョンを返す"""
+    return struct.unpack_from('<Q', _version_map(database), 0)[0]
+
+def data_version_tag():
+    """ETag 用の識別子。カウンターのファイルが作り直されても古い値と衝突しないよう inode を含める"""
+    path = current_database() + '.version'
+    _version_map()
+    return f'{os.stat(path).st_ino:x}-{data_version()}'
+
+def bump_data_version(database=None):
+    """書き込みのコミット後に呼び出してキャッシュを無効化する"""
+    database = database or current_database()
+    mm = _version_map(database)
+    with _version_lock:
+        if fcntl is not None:
+            fd = os.open(database + '.version', os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                version = struct.unpack_from('<Q', mm, 0)[0] + 1
+                struct.pack_into('<Q', mm, 0, version)
+            finally:
+                os.close(fd)
+        else:
+            version = struct.unpack_from('<Q', mm, 0)[0] + 1
+            struct.pack_into('<Q', mm, 0, version)
+    return version
+
+# ログイン中の店舗の確認（別の店舗の URL を開いたら、その店舗でログインし直す）
+def logged_in():
+    return 'user_id' in session and session.get('store_id') == current_store()
+
 # ログイン必須デコレーター
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if not logged_in():
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -119,7 +1127,7 @@ def login_required(f):
 def owner_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if not logged_in():
             return redirect(url_for('login'))
         if session.get('role') != 'owner':
             flash('この操作は店主のみ可能です', 'error')
@@ -127,6 +1135,17 @@ def owner_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# 画面操作の結果を返す
+# fetch から Accept: application/json で呼ばれた場合は JSON、それ以外は従来どおりフラッシュ＋リダイレクト
+def wants_json():
+    return request.is_json or request.accept_mimetypes.best == 'application/json'
+
+def _action_result(ok, message, status=200, endpoint='index', **data):
+    if wants_json():
+        return jsonify(ok=ok, message=message, **data), status
+    flash(message, 'success' if ok else 'error')
+    return redirect(url_for(endpoint))
+
 # ログイン画面
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -134,6 +1153,15 @@ def login():
         name = request.form['name']
         role = request.form['role']
         
+        # URL やサブドメインで店舗が決まっていなければ、フォームで選んだ店舗にログインする
+        if app.config['STORES'] and requested_store() is None:
+            store_id = request.form.get('store_id')
+            if store_id not in app.config['STORES']:
+                flash('店舗を選択してください', 'error')
+                return render_template('login.html')
+            session['store_id'] = store_id
+        session['store_id'] = current_store()
+        
         conn = get_db()
         user = conn.execute('SELECT * FROM USERS WHERE name = ? AND role = ?', (name, role)).fetchone()
         
@@ -165,25 +1193,50 @@ def logout():
     return redirect(url_for('login'))
 
 # メイン画面（在庫一覧）
-@app.route('/')
-@login_required
-def index():
-    conn = get_db()
-    
-    # カテゴリー一覧を取得
-    categories = conn.execute('SELECT * FROM CATEGORIES ORDER BY display_order, category_id').fetchall()
+# 在庫一覧のキャッシュ（データバージョンが変わるまで SQL を発行しない）
+_dashboard_cache = {}
+_dashboard_cache_lock = threading.Lock()
+
+def load_dashboard(conn, today=None):
+    """カテゴリー・品目・未解決通知を1回の JOIN と通知クエリでまとめて取得"""
+    today = today or date.today()
+    rows = conn.execute('''
+        SELECT c.category_id, c.name as category_name, c.icon_path,
+               i.item_id, i.name, i.unit, i.current_quantity, i.min_threshold,
+               i.supplier_id, i.display_order, s.name as supplier_name,
+               f.rate, f.day, f.day_used
+        FROM CATEGORIES c
+        LEFT JOIN ITEMS i ON i.category_id = c.category_id AND i.is_active = 1
+        LEFT JOIN SUPPLIERS s ON i.supplier_id = s.supplier_id
+        LEFT JOIN ITEM_FORECAST f ON f.item_id = i.item_id
+        ORDER BY c.display_order, c.category_id, i.display_order, i.item_id
+    ''').fetchall()
     
-    # カテゴリーごとの品目を取得
+    categories = []
     items_by_category = {}
-    for category in categories:
-        items = conn.execute('''
-            SELECT i.*, s.name as supplier_name 
-            FROM ITEMS i
-            LEFT JOIN SUPPLIERS s ON i.supplier_id = s.supplier_id
-            WHERE i.is_active = 1 AND i.category_id = ?
-            ORDER BY i.display_order, i.item_id
-        ''', (category['category_id'],)).fetchall()
-        items_by_category[category['category_id']] = items
+    for row in rows:
+        category_id = row['category_id']
+        if category_id not in items_by_category:
+            categories.append({
+                'category_id': category_id,
+                'name': row['category_name'],
+                'icon_path': row['icon_path'],
+            })
+            items_by_category[category_id] = []
+        if row['item_id'] is not None:
+            items_by_category[category_id].append({
+                'item_id': row['item_id'],
+                'category_id': category_id,
+                'name': row['name'],
+                'unit': row['unit'],
+                'current_quantity': row['current_quantity'],
+                'min_threshold': row['min_threshold'],
+                'supplier_id': row['supplier_id'],
+                'display_order': row['display_order'],
+                'supplier_name': row['supplier_name'],
+                'forecast': item_forecast(row['current_quantity'], row['min_threshold'],
+                                          row['rate'], row['day'], row['day_used'], today),
+            })
     
     # 通知チェック
     notifications = conn.execute('''
@@ -194,8 +1247,284 @@ def index():
         ORDER BY n.triggered_at DESC
     ''').fetchall()
     
-    conn.close()
-    return render_template('index.html', categories=categories, items_by_category=items_by_category, notifications=notifications)
+    change_seq = conn.execute('SELECT seq FROM CHANGE_SEQ WHERE id = 1').fetchone()[0]
+    
+    return {
+        'categories': categories,
+        'items_by_category': items_by_category,
+        'notifications': notifications,
+        'change_seq': change_seq,
+    }
+
+def get_dashboard():
+    """在庫一覧のデータをキャッシュから返す（書き込みがあったか日付が変わったら読み直す）"""
+    key = current_database()
+    today = date.today()
+    version = (data_version(), today)  # 在庫切れ予測は日付でも変わる
+    cached = _dashboard_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    data = load_dashboard(get_db(), today)
+    with _dashboard_cache_lock:
+        _dashboard_cache[key] = (version, data)
+    return data
+
+@app.route('/')
+@login_required
+def index():
+    dashboard = get_dashboard()
+    return render_template('index.html', categories=dashboard['categories'],
+                           items_by_category=dashboard['items_by_category'],
+                           notifications=dashboard['notifications'],
+                           change_seq=dashboard['change_seq'])
+
+# 在庫 JSON API（スマホ・タブレットの定期更新用）
+# ETag はデータバージョンから作るので、変更がなければデータベースに触れずに 304 を返す。
+# ?since=<version> を付けると、その version より後に変わった品目・通知だけを返す。
+API_ITEM_COLUMNS = ('item_id', 'category_id', 'name', 'unit', 'current_quantity',
+                    'min_threshold', 'supplier_name', 'display_order')
+
+def _api_notification(row):
+    return {
+        'notification_id': row['notification_id'],
+        'item_id': row['item_id'],
+        'item_name': row['item_name'],
+        'triggered_at': row['triggered_at'],
+        'threshold_at_time': row['threshold_at_time'],
+        'quantity_at_time': row['quantity_at_time'],
+        'is_resolved': row['is_resolved'],
+    }
+
+def load_inventory_changes(conn, since):
+    """since より後に変わった品目（削除済みを含む）と通知（解決済みを含む）を返す
+    
+    is_active は 0/1 で返す（ゴミ箱の整理中の -1 も 0）。完全に削除した品目は
+    {item_id, is_active: 0, deleted: true} として返す。
+    """
+    items = conn.execute('''
+        SELECT i.item_id, i.category_id, i.name, i.unit, i.current_quantity, i.min_threshold,
+               s.name as supplier_name, i.display_order, i.is_active = 1 as is_active
+        FROM ITEMS i
+        LEFT JOIN SUPPLIERS s ON i.supplier_id = s.supplier_id
+        WHERE i.change_seq > ?
+        ORDER BY i.change_seq
+    ''', (since,)).fetchall()
+    deleted = conn.execute('''
+        SELECT item_id FROM ITEM_TOMBSTONES
+        WHERE change_seq > ?
+        ORDER BY change_seq
+    ''', (since,)).fetchall()
+    notifications = load_notification_changes(conn, since)
+    categories = conn.execute('SELECT category_id, name, icon_path FROM CATEGORIES ORDER BY display_order, category_id').fetchall()
+    change_seq = conn.execute('SELECT seq FROM CHANGE_SEQ WHERE id = 1').fetchone()[0]
+    return {
+        'version': change_seq,
+        'full': False,
+        'categories': [dict(row) for row in categories],
+        'items': [dict(row) for row in items]
+                 + [{'item_id': row['item_id'], 'is_active': 0, 'deleted': True} for row in deleted],
+        'notifications': [_api_notification(row) for row in notifications],
+    }
+
+@app.route('/api/inventory')
+@login_required
+def api_inventory():
+    since = request.args.get('since', '')
+    etag = data_version_tag()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+    
+    if since.isdigit():
+        payload = load_inventory_changes(get_db(), int(since))
+    else:
+        dashboard = get_dashboard()
+        payload = {
+            'version': dashboard['change_seq'],
+            'full': True,
+            'categories': [dict(category) for category in dashboard['categories']],
+            'items': [
+                {column: item[column] for column in API_ITEM_COLUMNS} | {'is_active': 1}
+                for category in dashboard['categories']
+                for item in dashboard['items_by_category'][category['category_id']]
+            ],
+            'notifications': [_api_notification(row) for row in dashboard['notifications']],
+        }
+    
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# 品目の検索（ITEM_SEARCH）
+# 3文字以上の語は trigram の索引で MATCH し、1〜2文字の語（「牛乳」など）は部分一致（LIKE）で絞り込む。
+# 品目名が最初の語で始まるものを先に、次に bm25 の関連度（品目名を重視）の順に並べる。
+SEARCH_LIMIT = 20
+SEARCH_MAX_TERMS = 5
+SEARCH_COLUMNS = ('name', 'unit', 'supplier_name', 'category_name')
+
+def _like_escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_items(conn, query, limit=SEARCH_LIMIT):
+    """検索語（空白区切りはすべて含むもの）に一致する有効な品目を関連度順に返す"""
+    terms = query.split()[:SEARCH_MAX_TERMS]
+    if not terms:
+        return []
+    long_terms = [term for term in terms if len(term) >= 3]
+    short_terms = [term for term in terms if len(term) < 3]
+    
+    conditions = ['i.is_active = 1']
+    params = []
+    if long_terms:
+        conditions.append('ITEM_SEARCH MATCH ?')
+        params.append(' AND '.join('"' + term.replace('"', '""') + '"' for term in long_terms))
+    for term in short_terms:
+        conditions.append('(' + ' OR '.join(f"ITEM_SEARCH.{column} LIKE ? ESCAPE '\\'"
+                                            for column in SEARCH_COLUMNS) + ')')
+        params.extend(['%' + _like_escape(term) + '%'] * len(SEARCH_COLUMNS))
+    # 品目名が最初の語で始まるもの → 関連度（MATCH したときだけ）→ 表示順
+    order = [f"CASE WHEN ITEM_SEARCH.name LIKE ? ESCAPE '\\' THEN 0 ELSE 1 END"]
+    if long_terms:
+        order.append('bm25(ITEM_SEARCH, 10.0, 1.0, 2.0, 2.0)')
+    order.extend(['i.display_order', 'i.name'])
+    
+    rows = conn.execute(f'''
+        SELECT i.item_id, i.category_id, i.name, i.unit, i.current_quantity, i.min_threshold,
+               ITEM_SEARCH.supplier_name, ITEM_SEARCH.category_name, i.display_order
+        FROM ITEM_SEARCH
+        JOIN ITEMS i ON i.item_id = ITEM_SEARCH.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(order)}
+        LIMIT ?
+    ''', (*params, _like_escape(terms[0]) + '%', limit)).fetchall()
+    return [{column: row[column] for column in API_ITEM_COLUMNS} | {'category_name': row['category_name']}
+            for row in rows]
+
+@app.route('/api/items/search')
+@login_required
+def api_search_items():
+    """?q= に一致する品目だけを返す（在庫一覧の検索欄から入力のたびに呼ばれる）"""
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', SEARCH_LIMIT, type=int), 50)
+    return jsonify({'query': query, 'items': search_items(get_db(), query, max(limit, 1))})
+
+# 在庫変更のプッシュ配信（Server-Sent Events）
+# ワーカーごとに1本の監視スレッドが共有カウンター（data_version）を見張り、
+# 変わったときだけ CHANGE_SEQ 以降の変更を1回読んで、そのワーカーの購読者全員に配る。
+# カウンターとデータベースは同じホストの全ワーカーで共有されるので、外部のブローカーは不要。
+# ※ストリームは接続中ワーカーを占有するので、既定（SSE_ENABLED=False）では使わず、在庫一覧は
+#   /api/inventory?since= を INVENTORY_POLL_SECONDS ごとに確認する（ETag が同じなら 304）。
+#   ZAIKO_SSE=1 で有効にする場合は、gunicorn を gthread ワーカー
+#   （例: --worker-class gthread --threads 8）で動かすこと。
+class ChangeBroadcaster:
+    def __init__(self, database):
+        self.database = database
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=app.config['SSE_QUEUE_SIZE'])
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+    
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # 読み出しが追いつかない購読者は溜まった分を捨て、全体の再取得を促す
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(('resync', {}))
+    
+    def _run(self):
+        conn = _connect(self.database)
+        try:
+            version = data_version(self.database)
+            seq = conn.execute('SELECT seq FROM CHANGE_SEQ WHERE id = 1').fetchone()[0]
+            while True:
+                time.sleep(app.config['SSE_POLL_INTERVAL'])
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                current = data_version(self.database)
+                if current == version:
+                    continue
+                version = current
+                changes = load_inventory_changes(conn, seq)
+                conn.commit()  # 読み取りトランザクションを終えて次回は最新を読む
+                if changes['version'] != seq:
+                    seq = changes['version']
+                    self.publish(('changes', changes))
+        finally:
+            conn.close()
+
+_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+def get_broadcaster():
+    database = current_database()
+    with _broadcasters_lock:
+        if database not in _broadcasters:
+            _broadcasters[database] = ChangeBroadcaster(database)
+        return _broadcasters[database]
+
+def _sse(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/events')
+@login_required
+def events():
+    if not app.config['SSE_ENABLED']:
+        return Response(status=204)  # 204 を受け取ったブラウザは再接続しない
+    
+    # 再接続時は Last-Event-ID（＝最後に受け取った変更番号）以降、
+    # 初回はページを表示した時点の変更番号（?since=）以降をまず送る
+    last_event_id = request.headers.get('Last-Event-ID', '') or request.args.get('since', '')
+    backlog = None
+    if last_event_id.isdigit():
+        backlog = load_inventory_changes(get_db(), int(last_event_id))
+    
+    broadcaster = get_broadcaster()
+    subscriber = broadcaster.subscribe()
+    heartbeat = app.config['SSE_HEARTBEAT_SECONDS']
+    deadline = time.monotonic() + app.config['SSE_MAX_SECONDS']
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            if backlog and (backlog['items'] or backlog['notifications']):
+                yield _sse('changes', backlog, backlog['version'])
+            while time.monotonic() < deadline:
+                try:
+                    event, data = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield _sse(event, data, data.get('version'))
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # 品目追加（店主のみ）
 @app.route('/add_item', methods=['GET', 'POST'])
@@ -220,7 +1549,7 @@ def add_item():
             VALUES (?, ?, 0, ?, ?, ?, ?)
         ''', (name, unit, min_threshold, supplier_id, category_id, session['user_id']))
         conn.commit()
-        conn.close()
+        bump_data_version()
         
         flash(f'品目「{name}」を追加しました', 'success')
         return redirect(url_for('index'))
@@ -229,52 +1558,343 @@ def add_item():
     conn = get_db()
     suppliers = conn.execute('SELECT * FROM SUPPLIERS ORDER BY name').fetchall()
     categories = conn.execute('SELECT * FROM CATEGORIES ORDER BY display_order, category_id').fetchall()
-    conn.close()
     
     return render_template('add_item.html', suppliers=suppliers, categories=categories)
 
+# 在庫不足の通知（作成・解決は ITEMS のトリガーが行う）
+def load_notification_changes(conn, since, item_ids=None):
+    """変更番号が since より後の通知（解決済みを含む）を返す"""
+    if item_ids is None:
+        return conn.execute('''
+            SELECT n.*, i.name as item_name
+            FROM NOTIFICATIONS n
+            JOIN ITEMS i ON n.item_id = i.item_id
+            WHERE n.change_seq > ?
+            ORDER BY n.change_seq
+        ''', (since,)).fetchall()
+    return conn.execute('''
+        SELECT n.*, i.name as item_name
+        FROM NOTIFICATIONS n
+        JOIN ITEMS i ON n.item_id = i.item_id
+        WHERE n.change_seq > ? AND n.item_id IN (SELECT value FROM json_each(?))
+        ORDER BY n.change_seq
+    ''', (since, json.dumps(list(item_ids)))).fetchall()
+
 # 在庫増減
+def apply_stock_movement(conn, item_id, quantity_delta, reason, note, user_id):
+    """在庫をデータベース内で加算し、取引・日別集計を記録する
+    
+    write_transaction() の中で呼ぶこと。(更新後の品目, 作成・解決された通知のリスト) を返し、
+    品目がなければ (None, []) を返す。
+    """
+    # 在庫更新（読み取りと書き込みを1文で行い、同時更新でも取りこぼさない）
+    # RETURNING の change_seq はトリガーで採番される前の値
+    item = conn.execute('''
+        UPDATE ITEMS SET current_quantity = current_quantity + ?, updated_at = ?
+        WHERE item_id = ?
+        RETURNING item_id, category_id, name, unit, current_quantity, min_threshold, is_active = 1 as is_active, change_seq
+    ''', (quantity_delta, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item_id)).fetchall()
+    if not item:
+        return None, []
+    item = item[0]
+    
+    # 取引記録
+    cursor = conn.execute('''
+        INSERT INTO STOCK_TRANSACTIONS (item_id, quantity_delta, reason, note, user_id)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (item_id, quantity_delta, reason, note, user_id))
+    record_daily_rollup(conn, cursor.lastrowid)
+    if reason in USAGE_REASONS and quantity_delta < 0:
+        record_usage_forecast(conn, [(item_id, -quantity_delta)])
+    
+    # 閾値をまたいだときだけ、トリガーが開閉した通知を読む
+    notifications = []
+    was_low = item['current_quantity'] - quantity_delta < item['min_threshold']
+    if was_low != (item['current_quantity'] < item['min_threshold']):
+        notifications = load_notification_changes(conn, item['change_seq'], [item_id])
+    
+    return item, notifications
+
 @app.route('/update_stock/<int:item_id>', methods=['POST'])
 @login_required
 def update_stock(item_id):
-    quantity_delta = float(request.form['quantity_delta'])
+    try:
+        quantity_delta = float(request.form['quantity_delta'])
+    except ValueError:
+        quantity_delta = 0
+    if not (math.isfinite(quantity_delta) and quantity_delta != 0):
+        return _action_result(False, '数量を入力してください（0以外）', 400)
     reason = request.form['reason']
     note = request.form.get('note', '')
     
     conn = get_db()
+    item, notifications = write_transaction(conn, lambda conn: apply_stock_movement(
+        conn, item_id, quantity_delta, reason, note, session['user_id']))
     
-    # 在庫更新
-    item = conn.execute('SELECT * FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
-    new_quantity = item['current_quantity'] + quantity_delta
+    if item is None:
+        return _action_result(False, '品目が見つかりませんでした', 404)
     
-    conn.execute('UPDATE ITEMS SET current_quantity = ?, updated_at = ? WHERE item_id = ?',
-                 (new_quantity, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item_id))
+    bump_data_version()
     
-    # 取引記録
-    conn.execute('''
+    item = {column: item[column] for column in item.keys() if column != 'change_seq'}
+    return _action_result(True, f'在庫を更新しました（変化: {quantity_delta:+g} {item["unit"]}）',
+                          item=item, notifications=[_api_notification(row) for row in notifications])
+
+# 品目の一括登録（CSV、店主のみ）
+# 見出しは英語・日本語どちらでもよい。数量は初期在庫として「棚卸し」の履歴も残す。
+IMPORT_HEADERS = {
+    'name': 'name', '品目名': 'name',
+    'unit': 'unit', '単位': 'unit',
+    'min_threshold': 'min_threshold', '最低在庫量': 'min_threshold',
+    'supplier': 'supplier', '仕入先': 'supplier',
+    'category': 'category', 'カテゴリー': 'category',
+    'quantity': 'quantity', '在庫数': 'quantity',
+}
+IMPORT_CHUNK_SIZE = 1000
+
+def read_import_csv(data):
+    """CSV のバイト列を行の辞書のリストにする（UTF-8 / Shift_JIS）"""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp932')
+    reader = csv.DictReader(io.StringIO(text))
+    rows = []
+    for record in reader:
+        rows.append({IMPORT_HEADERS[key.strip()]: (value or '').strip()
+                     for key, value in record.items() if key and key.strip() in IMPORT_HEADERS})
+    return rows
+
+def _float_or_default(value, default):
+    return float(value) if value else default
+
+def import_items(conn, rows, user_id, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """品目と初期在庫をまとめて登録し、結果の集計を返す
+    
+    全行を検証してから、仕入先・カテゴリーを1回の検索で解決（なければ作成）し、
+    chunk_size 行ごとのトランザクションで executemany する。
+    """
+    summary = {'rows': len(rows), 'imported': 0, 'errors': [],
+               'new_suppliers': [], 'new_categories': [], 'dry_run': dry_run}
+    
+    existing_names = {row['name'] for row in conn.execute('SELECT name FROM ITEMS WHERE is_active = 1')}
+    seen = set()
+    valid = []
+    for line, row in enumerate(rows, start=2):  # 1行目は見出し
+        name = row.get('name', '')
+        try:
+            min_threshold = _float_or_default(row.get('min_threshold'), 0)
+            quantity = _float_or_default(row.get('quantity'), 0)
+        except ValueError:
+            summary['errors'].append((line, '最低在庫量・在庫数は数値で指定してください'))
+            continue
+        if not (math.isfinite(min_threshold) and math.isfinite(quantity)):
+            summary['errors'].append((line, '最低在庫量・在庫数は有限の数値で指定してください'))
+            continue
+        if not name:
+            summary['errors'].append((line, '品目名がありません'))
+        elif name in existing_names or name in seen:
+            summary['errors'].append((line, f'品目「{name}」は既に登録されています'))
+        else:
+            seen.add(name)
+            valid.append((name, row.get('unit', ''), min_threshold,
+                          row.get('supplier', ''), row.get('category', ''), quantity))
+    
+    summary['valid'] = len(valid)
+    
+    # 仕入先・カテゴリーの名前を一度に解決
+    suppliers = {row['name']: row['supplier_id'] for row in conn.execute('SELECT supplier_id, name FROM SUPPLIERS')}
+    categories = {row['name']: row['category_id'] for row in conn.execute('SELECT category_id, name FROM CATEGORIES')}
+    summary['new_suppliers'] = sorted({row[3] for row in valid if row[3] and row[3] not in suppliers})
+    summary['new_categories'] = sorted({row[4] for row in valid if row[4] and row[4] not in categories})
+    
+    if dry_run or not valid:
+        return summary
+    
+    if summary['new_suppliers'] or summary['new_categories']:
+        def create_lookups(conn):
+            conn.executemany('INSERT INTO SUPPLIERS (name) VALUES (?)',
+                             [(name,) for name in summary['new_suppliers']])
+            conn.executemany('INSERT INTO CATEGORIES (name) VALUES (?)',
+                             [(name,) for name in summary['new_categories']])
+        write_transaction(conn, create_lookups)
+        suppliers = {row['name']: row['supplier_id'] for row in conn.execute('SELECT supplier_id, name FROM SUPPLIERS')}
+        categories = {row['name']: row['category_id'] for row in conn.execute('SELECT category_id, name FROM CATEGORIES')}
+    
+    def insert_chunk(conn, chunk):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        before_item_id = conn.execute('SELECT COALESCE(MAX(item_id), 0) FROM ITEMS').fetchone()[0]
+        conn.executemany('''
+            INSERT INTO ITEMS (name, unit, current_quantity, min_threshold, supplier_id, category_id, created_by, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(name, unit, quantity, min_threshold, suppliers.get(supplier), categories.get(category), user_id, now)
+              for name, unit, min_threshold, supplier, category, quantity in chunk])
+        # 書き込みを独占しているので、直前の最大 item_id より後がこのチャンクの品目（挿入順）
+        item_ids = [row[0] for row in conn.execute(
+            'SELECT item_id FROM ITEMS WHERE item_id > ? ORDER BY item_id', (before_item_id,))]
+        
+        # 初期在庫を履歴に残す
+        opening = [(item_id, row[5], '棚卸し', '初期在庫（一括登録）', user_id)
+                   for item_id, row in zip(item_ids, chunk) if row[5]]
+        if opening:
+            before_tx_id = conn.execute('SELECT COALESCE(MAX(tx_id), 0) FROM STOCK_TRANSACTIONS').fetchone()[0]
+            conn.executemany('''
+                INSERT INTO STOCK_TRANSACTIONS (item_id, quantity_delta, reason, note, user_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', opening)
+            last_tx_id = conn.execute('SELECT MAX(tx_id) FROM STOCK_TRANSACTIONS').fetchone()[0]
+            record_daily_rollup(conn, before_tx_id + 1, last_tx_id)
+    
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        write_transaction(conn, lambda conn: insert_chunk(conn, chunk))
+        summary['imported'] += len(chunk)
+    return summary
+
+@app.route('/import_items', methods=['GET', 'POST'])
+@owner_required
+def import_items_upload():
+    if request.method == 'GET':
+        return render_template('import_items.html', summary=None)
+    
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('CSVファイルを選択してください', 'error')
+        return redirect(url_for('import_items_upload'))
+    
+    try:
+        rows = read_import_csv(upload.read())
+    except (UnicodeDecodeError, csv.Error):
+        flash('CSVファイルを読み込めませんでした', 'error')
+        return redirect(url_for('import_items_upload'))
+    
+    dry_run = bool(request.form.get('dry_run'))
+    summary = import_items(get_db(), rows, session['user_id'], dry_run=dry_run)
+    if summary['imported']:
+        bump_data_version()
+        flash(f'{summary["imported"]}品目を登録しました', 'success')
+    return render_template('import_items.html', summary=summary)
+
+# 一括入出庫（納品の受け入れ・棚卸しなど）
+def parse_bulk_rows(req):
+    """JSON（{"rows": [...]}）またはフォームの並列リストから行のリストを作る"""
+    if req.is_json:
+        payload = req.get_json(silent=True) or {}
+        rows = payload.get('rows', payload) if isinstance(payload, dict) else payload
+        if not isinstance(rows, list):
+            return []
+        return [row if isinstance(row, dict) else {} for row in rows]
+    
+    reason = req.form.get('reason', '')
+    notes = req.form.getlist('note')
+    rows = []
+    for index, (item_id, quantity) in enumerate(zip(req.form.getlist('item_id'), req.form.getlist('quantity_delta'))):
+        if not quantity.strip():
+            continue  # 数量が空欄の品目は対象外
+        rows.append({
+            'item_id': item_id,
+            'quantity_delta': quantity,
+            'reason': reason,
+            'note': notes[index] if index < len(notes) else '',
+        })
+    return rows
+
+def apply_bulk_movements(conn, rows, user_id):
+    """複数行の在庫増減を1つのトランザクションで反映し、行ごとの結果を返す
+    
+    write_transaction() の中で呼ぶこと。
+    """
+    results = []
+    valid = []
+    for index, row in enumerate(rows):
+        result = {'row': index, 'item_id': row.get('item_id')}
+        try:
+            item_id = int(row['item_id'])
+            quantity_delta = float(row['quantity_delta'])
+            reason = str(row.get('reason') or '')
+        except (KeyError, TypeError, ValueError):
+            result.update(status='invalid', error='item_id と quantity_delta は数値で指定してください')
+        else:
+            if not (math.isfinite(quantity_delta) and quantity_delta != 0):
+                result.update(status='invalid', error='数量は0以外で指定してください')
+            elif not reason:
+                result.update(status='invalid', error='理由を指定してください')
+            else:
+                result.update(item_id=item_id, quantity_delta=quantity_delta, status='ok')
+                valid.append((result, (item_id, quantity_delta, reason, str(row.get('note') or ''), user_id)))
+        results.append(result)
+    
+    if valid:
+        item_ids = sorted({params[0] for _, params in valid})
+        existing = {row['item_id'] for row in conn.execute(
+            'SELECT item_id FROM ITEMS WHERE item_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(item_ids),))}
+        for result, params in valid:
+            if params[0] not in existing:
+                result.update(status='not_found', error='品目が見つかりませんでした')
+        valid = [(result, params) for result, params in valid if params[0] in existing]
+    
+    if not valid:
+        return results, []
+    
+    before_seq = conn.execute('SELECT seq FROM CHANGE_SEQ WHERE id = 1').fetchone()[0]
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn.executemany('UPDATE ITEMS SET current_quantity = current_quantity + ?, updated_at = ? WHERE item_id = ?',
+                     [(params[1], now, params[0]) for _, params in valid])
+    
+    # BEGIN IMMEDIATE で書き込みを独占しているので、直前の最大 tx_id より後がこのバッチの取引
+    before_tx_id = conn.execute('SELECT COALESCE(MAX(tx_id), 0) FROM STOCK_TRANSACTIONS').fetchone()[0]
+    conn.executemany('''
         INSERT INTO STOCK_TRANSACTIONS (item_id, quantity_delta, reason, note, user_id)
         VALUES (?, ?, ?, ?, ?)
-    ''', (item_id, quantity_delta, reason, note, session['user_id']))
-    
-    # 閾値チェック → 通知作成
-    if new_quantity < item['min_threshold']:
-        # 未解決の同じ品目の通知がなければ作成
-        existing = conn.execute('''
-            SELECT * FROM NOTIFICATIONS 
-            WHERE item_id = ? AND is_resolved = 0
-        ''', (item_id,)).fetchone()
-        
-        if not existing:
-            conn.execute('''
-                INSERT INTO NOTIFICATIONS (item_id, type, threshold_at_time, quantity_at_time)
-                VALUES (?, 'low_stock', ?, ?)
-            ''', (item_id, item['min_threshold'], new_quantity))
+    ''', [params for _, params in valid])
+    last_tx_id = conn.execute('SELECT MAX(tx_id) FROM STOCK_TRANSACTIONS').fetchone()[0]
+    record_daily_rollup(conn, before_tx_id + 1, last_tx_id)
+    record_usage_forecast(conn, [(params[0], -params[1]) for _, params in valid
+                                 if params[2] in USAGE_REASONS and params[1] < 0])
     
-    conn.commit()
-    conn.close()
+    # トリガーが開閉した通知（書き込みを独占しているので before_seq より後はこのバッチの分）
+    affected = sorted({params[0] for _, params in valid})
+    notifications = load_notification_changes(conn, before_seq)
+    quantities = dict(conn.execute(
+        'SELECT item_id, current_quantity FROM ITEMS WHERE item_id IN (SELECT value FROM json_each(?))',
+        (json.dumps(affected),)).fetchall())
+    for result, params in valid:
+        result['current_quantity'] = quantities[params[0]]
     
-    flash(f'在庫を更新しました（変化: {quantity_delta:+g} {item["unit"]}）', 'success')
-    return redirect(url_for('index'))
+    return results, notifications
+
+@app.route('/bulk_update_stock', methods=['GET', 'POST'])
+@login_required
+def bulk_update_stock():
+    if request.method == 'GET':
+        dashboard = get_dashboard()
+        return render_template('bulk_stock.html', categories=dashboard['categories'],
+                               items_by_category=dashboard['items_by_category'])
+    
+    rows = parse_bulk_rows(request)
+    conn = get_db()
+    results, notifications = write_transaction(
+        conn, lambda conn: apply_bulk_movements(conn, rows, session['user_id']))
+    applied = sum(1 for result in results if result['status'] == 'ok')
+    if applied:
+        bump_data_version()
+    
+    if request.is_json:
+        return jsonify({
+            'applied': applied,
+            'results': results,
+            'notifications': [_api_notification(row) for row in notifications],
+        })
+    
+    if applied:
+        flash(f'{applied}件の在庫をまとめて更新しました', 'success')
+    for result in results:
+        if result['status'] != 'ok':
+            flash(f'{result["row"] + 1}行目: {result["error"]}', 'error')
+    if not results:
+        flash('数量が入力された品目がありません', 'error')
+    return redirect(url_for('index') if applied else url_for('bulk_update_stock'))
 
 # 通知解決
 @app.route('/resolve_notification/<int:notification_id>')
@@ -283,46 +1903,487 @@ def resolve_notification(notification_id):
     conn = get_db()
     conn.execute('UPDATE NOTIFICATIONS SET is_resolved = 1 WHERE notification_id = ?', (notification_id,))
     conn.commit()
-    conn.close()
+    bump_data_version()
     
     flash('通知を解決しました', 'info')
     return redirect(url_for('index'))
 
-# 履歴表示
-@app.route('/history')
-@login_required
-def history():
-    conn = get_db()
-    transactions = conn.execute('''
-        SELECT st.*, i.name as item_name, i.unit, u.name as user_name
-        FROM STOCK_TRANSACTIONS st
-        JOIN ITEMS i ON st.item_id = i.item_id
-        JOIN USERS u ON st.user_id = u.user_id
-        ORDER BY st.created_at DESC
-        LIMIT 100
-    ''').fetchall()
-    conn.close()
+# 履歴のアーカイブ（flask --app app archive-ledger で作成）
+# 古い月の STOCK_TRANSACTIONS は月ごとの別ファイルに移し、ARCHIVED_MONTHS に記録する。
+# 在庫数・日別集計はメインのデータベースに残るので、統計画面はアーカイブを読まない。
+# 履歴・出力がアーカイブした月まで届いたときだけ、その月のファイルを ATTACH する。
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS {schema}.STOCK_TRANSACTIONS (
+        tx_id INTEGER PRIMARY KEY,
+        item_id INTEGER NOT NULL,
+        quantity_delta REAL NOT NULL,
+        reason TEXT,
+        note TEXT,
+        user_id INTEGER,
+        created_at TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_stock_tx_created ON STOCK_TRANSACTIONS(created_at)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_stock_tx_item_created ON STOCK_TRANSACTIONS(item_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_stock_tx_user_created ON STOCK_TRANSACTIONS(user_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_stock_tx_reason_created ON STOCK_TRANSACTIONS(reason, created_at)',
+]
+
+def archive_dir(database=None):
+    database = database or current_database()
+    return app.config['ARCHIVE_DIR'] or os.path.join(os.path.dirname(os.path.abspath(database)), 'archive')
+
+def archive_filename(month, database=None):
+    """アーカイブのファイル名（同じフォルダの他のデータベースと混ざらないよう名前を付ける）"""
+    stem = os.path.splitext(os.path.basename(database or current_database()))[0]
+    return f'{stem}_ledger_{month}.db'
+
+def archived_months(conn, first_month=None, last_month=None, newest_first=False):
+    """first_month〜last_month（どちらも含む）のアーカイブ済みの月と、そのファイル名を返す"""
+    return conn.execute(f'''
+        SELECT month, path FROM ARCHIVED_MONTHS
+        WHERE month >= COALESCE(?, '') AND month <= COALESCE(?, '9999-12')
+        ORDER BY month {'DESC' if newest_first else 'ASC'}
+    ''', (first_month, last_month)).fetchall()
+
+@contextmanager
+def attach_archive(conn, month, path):
+    """アーカイブの月のファイルを ATTACH し、スキーマ名を渡す（抜けるときに DETACH する）"""
+    schema = 'archive_' + month.replace('-', '_')
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (os.path.join(archive_dir(), path),))
+    try:
+        yield schema
+    finally:
+        conn.execute(f'DETACH DATABASE {schema}')
+
+def _filter_month_bounds(filters):
+    """履歴の絞り込みから (最初の月, 最後の月) を返す（指定がなければ None）"""
+    if 'month' in filters:
+        return filters['month'], filters['month']
+    return filters.get('date_from', '')[:7] or None, filters.get('date_to', '')[:7] or None
+
+def archive_horizon(months=None):
+    """months ヶ月より前（省略時は ARCHIVE_HORIZON_MONTHS）をアーカイブする境目の日付"""
+    months = app.config['ARCHIVE_HORIZON_MONTHS'] if months is None else months
+    return _months_ago(date.today(), months).replace(day=1).isoformat()
+
+def archive_targets(conn, months=None):
+    """アーカイブする月と件数（古い順）"""
+    return conn.execute('''
+        SELECT substr(created_at, 1, 7) as month, COUNT(*) as count
+        FROM STOCK_TRANSACTIONS
+        WHERE created_at < ?
+        GROUP BY month
+        ORDER BY month
+    ''', (archive_horizon(months),)).fetchall()
+
+def archive_month(conn, month):
+    """month の履歴をアーカイブのファイルに移し、移した件数を返す
     
-    return render_template('history.html', transactions=transactions)
-# 品目削除（店主のみ・論理削除）
-@app.route('/delete_item/<int:item_id>', methods=['POST'])
-@owner_required
-def delete_item(item_id):
-    conn = get_db()
+    先にアーカイブ側へコピーしてコミットし、確認してからメインから削除する。
+    途中で止まっても、もう一度実行すれば続きから同じ結果になる。
+    """
+    start_day, end_day = month_range(month)
+    path = archive_filename(month)
+    os.makedirs(archive_dir(), exist_ok=True)
     
-    # 品目名を取得（メッセージ用）
-    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
+    conn.execute('ATTACH DATABASE ? AS archive_target', (os.path.join(archive_dir(), path),))
+    try:
+        def copy(conn):
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement.format(schema='archive_target'))
+            conn.execute('''
+                INSERT OR IGNORE INTO archive_target.STOCK_TRANSACTIONS
+                    (tx_id, item_id, quantity_delta, reason, note, user_id, created_at)
+                SELECT tx_id, item_id, quantity_delta, reason, note, user_id, created_at
+                FROM main.STOCK_TRANSACTIONS
+                WHERE created_at >= ? AND created_at < ?
+            ''', (start_day, end_day))
+        write_transaction(conn, copy)
+        missing = conn.execute('''
+            SELECT COUNT(*) FROM main.STOCK_TRANSACTIONS m
+            WHERE m.created_at >= ? AND m.created_at < ?
+            AND NOT EXISTS (SELECT 1 FROM archive_target.STOCK_TRANSACTIONS a WHERE a.tx_id = m.tx_id)
+        ''', (start_day, end_day)).fetchone()[0]
+    finally:
+        conn.execute('DETACH DATABASE archive_target')
+    if missing:
+        raise RuntimeError(f'{month}: アーカイブへのコピーが {missing}件 足りません')
     
-    if item:
-        # 論理削除（is_active を 0 に設定）
-        conn.execute('UPDATE ITEMS SET is_active = 0 WHERE item_id = ?', (item_id,))
-        conn.commit()
-        flash(f'品目「{item["name"]}」を削除しました', 'success')
+    def move(conn):
+        # 品目ごとに、この月の最後の取引までの残高を記録する（前回のスナップショット + その後の取引）
+        conn.execute('''
+            WITH batch AS (
+                SELECT item_id, MAX(tx_id) as last_tx_id
+                FROM STOCK_TRANSACTIONS
+                WHERE created_at >= ? AND created_at < ?
+                GROUP BY item_id
+            ),
+            previous AS (
+                SELECT b.item_id, b.last_tx_id,
+                       COALESCE((SELECT MAX(s.tx_id) FROM ITEM_BALANCE_SNAPSHOTS s
+                                 WHERE s.item_id = b.item_id AND s.tx_id <= b.last_tx_id), 0) as tx_id
+                FROM batch b
+            )
+            INSERT OR REPLACE INTO ITEM_BALANCE_SNAPSHOTS (item_id, tx_id, quantity)
+            SELECT p.item_id, p.last_tx_id,
+                   COALESCE((SELECT s.quantity FROM ITEM_BALANCE_SNAPSHOTS s
+                             WHERE s.item_id = p.item_id AND s.tx_id = p.tx_id), 0)
+                   + (SELECT COALESCE(SUM(t.quantity_delta), 0) FROM STOCK_TRANSACTIONS t
+                      WHERE t.item_id = p.item_id AND t.tx_id > p.tx_id AND t.tx_id <= p.last_tx_id)
+            FROM previous p
+        ''', (start_day, end_day))
+        stats = conn.execute('''
+            SELECT COUNT(*), MAX(tx_id) FROM STOCK_TRANSACTIONS WHERE created_at >= ? AND created_at < ?
+        ''', (start_day, end_day)).fetchone()
+        conn.execute('DELETE FROM STOCK_TRANSACTIONS WHERE created_at >= ? AND created_at < ?', (start_day, end_day))
+        conn.execute('''
+            INSERT INTO ARCHIVED_MONTHS (month, path, tx_count, last_tx_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT (month) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                last_tx_id = MAX(last_tx_id, excluded.last_tx_id),
+                archived_at = datetime('now', 'localtime')
+        ''', (month, path, stats[0], stats[1] or 0))
+        return stats[0]
+    
+    return write_transaction(conn, move)
+
+# 残高のチェックポイントと突き合わせ
+# チェックポイントでは全品目の「tx_id までの履歴の合計」を ITEM_BALANCE_SNAPSHOTS に記録する。
+# 残高は「品目ごとの直近のスナップショット + それより後の取引」で求めるので、
+# 読む履歴は直近のチェックポイント以降の分だけで済む。
+RECONCILE_TOLERANCE = 1e-6
+
+def ledger_balances(conn, upto_tx_id=None):
+    """履歴から求めた品目ごとの残高 {item_id: 数量} を返す（upto_tx_id を指定するとその時点）"""
+    upto = upto_tx_id if upto_tx_id is not None else conn.execute(
+        'SELECT COALESCE(MAX(tx_id), 0) FROM STOCK_TRANSACTIONS').fetchone()[0]
+    balances = {row[0]: row[1] for row in conn.execute('''
+        SELECT i.item_id, COALESCE(s.quantity, 0)
+        FROM ITEMS i
+        LEFT JOIN ITEM_BALANCE_SNAPSHOTS s ON s.item_id = i.item_id AND s.tx_id = (
+            SELECT MAX(tx_id) FROM ITEM_BALANCE_SNAPSHOTS WHERE item_id = i.item_id AND tx_id <= ?
+        )
+    ''', (upto,))}
+    
+    # チェックポイントより前の取引はスナップショットに含まれている
+    # （その後に作られた品目には、それより前の取引はない）
+    lower = conn.execute('SELECT COALESCE(MAX(tx_id), 0) FROM BALANCE_CHECKPOINTS WHERE tx_id <= ?',
+                         (upto,)).fetchone()[0]
+    for item_id, delta in conn.execute('''
+        SELECT t.item_id, SUM(t.quantity_delta)
+        FROM STOCK_TRANSACTIONS t
+        WHERE t.tx_id > ? AND t.tx_id <= ?
+        AND t.tx_id > COALESCE((SELECT MAX(s.tx_id) FROM ITEM_BALANCE_SNAPSHOTS s
+                                WHERE s.item_id = t.item_id AND s.tx_id <= ?), 0)
+        GROUP BY t.item_id
+    ''', (lower, upto, upto)):
+        if item_id in balances:
+            balances[item_id] += delta
+    return balances
+
+def create_balance_checkpoint(conn):
+    """現在の最後の取引までの全品目の残高を記録する（write_transaction() の中で呼ぶこと）"""
+    tx_id = conn.execute('SELECT COALESCE(MAX(tx_id), 0) FROM STOCK_TRANSACTIONS').fetchone()[0]
+    last = conn.execute('SELECT MAX(tx_id) FROM BALANCE_CHECKPOINTS').fetchone()[0]
+    if last is not None and last >= tx_id:
+        return None
+    balances = ledger_balances(conn, tx_id)
+    conn.executemany('INSERT OR REPLACE INTO ITEM_BALANCE_SNAPSHOTS (item_id, tx_id, quantity) VALUES (?, ?, ?)',
+                     [(item_id, tx_id, quantity) for item_id, quantity in balances.items()])
+    conn.execute('INSERT INTO BALANCE_CHECKPOINTS (tx_id, item_count) VALUES (?, ?)', (tx_id, len(balances)))
+    return {'tx_id': tx_id, 'item_count': len(balances)}
+
+def reconcile_stock(conn, repair=False):
+    """在庫数と履歴の残高を突き合わせ、ずれている品目を返す
+    
+    repair=True なら在庫数を履歴の残高に合わせる（write_transaction() の中で呼ぶこと）。
+    """
+    balances = ledger_balances(conn)
+    drift = []
+    for row in conn.execute('SELECT item_id, name, unit, current_quantity, is_active FROM ITEMS ORDER BY item_id'):
+        ledger_quantity = balances.get(row['item_id'], 0)
+        difference = row['current_quantity'] - ledger_quantity
+        if abs(difference) > RECONCILE_TOLERANCE * max(1, abs(ledger_quantity)):
+            drift.append({'item_id': row['item_id'], 'name': row['name'], 'unit': row['unit'],
+                          'is_active': row['is_active'], 'current_quantity': row['current_quantity'],
+                          'ledger_quantity': round(ledger_quantity, 6), 'drift': round(difference, 6)})
+    if repair and drift:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn.executemany('UPDATE ITEMS SET current_quantity = ?, updated_at = ? WHERE item_id = ?',
+                         [(row['ledger_quantity'], now, row['item_id']) for row in drift])
+    return {'checked_items': len(balances), 'drift': drift, 'repaired': bool(repair and drift)}
+
+def stock_as_of(conn, day):
+    """day の開始時点（その日の取引より前）の残高を返す。アーカイブ済みの期間なら None"""
+    last = conn.execute('''
+        SELECT tx_id FROM STOCK_TRANSACTIONS
+        WHERE created_at < ?
+        ORDER BY created_at DESC, tx_id DESC
+        LIMIT 1
+    ''', (day,)).fetchone()
+    if last is None:
+        archived = conn.execute('SELECT MAX(month) FROM ARCHIVED_MONTHS').fetchone()[0]
+        if archived is not None and day < month_range(archived)[1]:
+            return None
+        # day より前の取引はない（アーカイブ済みの月がある場合はそれより後の日付）
+        last_archived_tx = conn.execute('SELECT COALESCE(MAX(last_tx_id), 0) FROM ARCHIVED_MONTHS').fetchone()[0]
+        return last_archived_tx, ledger_balances(conn, last_archived_tx)
+    return last['tx_id'], ledger_balances(conn, last['tx_id'])
+
+@app.route('/api/reconciliation', methods=['GET', 'POST'])
+@owner_required
+def api_reconciliation():
+    """在庫数と履歴のずれを返す（POST なら在庫数を履歴に合わせてから返す）"""
+    conn = get_db()
+    if request.method == 'POST':
+        result = write_transaction(conn, lambda conn: reconcile_stock(conn, repair=True))
+        if result['repaired']:
+            bump_data_version()
     else:
-        flash('品目が見つかりませんでした', 'error')
+        result = reconcile_stock(conn)
+    checkpoint = conn.execute(
+        'SELECT tx_id, item_count, created_at FROM BALANCE_CHECKPOINTS ORDER BY checkpoint_id DESC LIMIT 1').fetchone()
+    result['checkpoint'] = dict(checkpoint) if checkpoint else None
+    return jsonify(result)
+
+@app.route('/api/stock_as_of')
+@login_required
+def api_stock_as_of():
+    """?date=YYYY-MM-DD の開始時点の在庫（履歴から求めた残高）"""
+    day = request.args.get('date', '')
+    try:
+        if not DATE_PATTERN.match(day):
+            raise ValueError(day)
+        date.fromisoformat(day)  # 2026-13-45 のような存在しない日付を弾く
+    except ValueError:
+        return jsonify({'error': 'date は YYYY-MM-DD で指定してください'}), 400
+    conn = get_db()
+    result = stock_as_of(conn, day)
+    if result is None:
+        return jsonify({'error': 'アーカイブ済みの期間です'}), 404
+    tx_id, balances = result
+    items = conn.execute('SELECT item_id, name, unit FROM ITEMS ORDER BY display_order, item_id').fetchall()
+    return jsonify({
+        'date': day,
+        'tx_id': tx_id,
+        'items': [{'item_id': row['item_id'], 'name': row['name'], 'unit': row['unit'],
+                   'quantity': round(balances.get(row['item_id'], 0), 6)} for row in items],
+    })
+
+# 履歴表示
+HISTORY_PAGE_SIZE = 100
+STOCK_REASONS = ('入荷', '使用', '廃棄', '棚卸し')
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+MONTH_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+def month_range(month):
+    """'YYYY-MM' を (月初日, 翌月初日) にする。列を関数で包まずに範囲条件で絞り込むために使う"""
+    year, month = map(int, month.split('-'))
+    next_year, next_month = divmod(year * 12 + month, 12)
+    return f'{year:04d}-{month:02d}-01', f'{next_year:04d}-{next_month + 1:02d}-01'
+
+def ledger_filters(args):
+    """品目・操作者・理由・期間の絞り込みを (WHERE 条件のリスト, パラメータ, 指定値) にする"""
+    conditions = []
+    params = []
+    filters = {}
     
-    conn.close()
-    return redirect(url_for('index'))
+    for name, column in (('item_id', 'st.item_id'), ('user_id', 'st.user_id')):
+        value = args.get(name, '')
+        if value.isdigit():
+            conditions.append(f'{column} = ?')
+            params.append(int(value))
+            filters[name] = value
+    
+    reason = args.get('reason', '')
+    if reason:
+        conditions.append('st.reason = ?')
+        params.append(reason)
+        filters['reason'] = reason
+    
+    # 月（created_at のインデックスで範囲検索できるよう strftime ではなく範囲条件にする）
+    month = args.get('month', '')
+    if MONTH_PATTERN.match(month):
+        start_day, end_day = month_range(month)
+        conditions.append('st.created_at >= ? AND st.created_at < ?')
+        params.extend([start_day, end_day])
+        filters['month'] = month
+    
+    # 期間（終了日はその日を含む）
+    date_from = args.get('date_from', '')
+    if DATE_PATTERN.match(date_from):
+        conditions.append('st.created_at >= ?')
+        params.append(date_from)
+        filters['date_from'] = date_from
+    date_to = args.get('date_to', '')
+    if DATE_PATTERN.match(date_to):
+        try:
+            next_day = date.fromisoformat(date_to) + timedelta(days=1)
+        except ValueError:
+            pass
+        else:
+            conditions.append('st.created_at < ?')
+            params.append(next_day.isoformat())
+            filters['date_to'] = date_to
+    
+    return conditions, params, filters
+
+def _parse_history_cursor(cursor):
+    """「created_at|tx_id」形式のカーソルを分解する（不正なら None）"""
+    created_at, _, tx_id = cursor.rpartition('|')
+    if not created_at or not tx_id.isdigit():
+        return None
+    return created_at, int(tx_id)
+
+@app.route('/history')
+@login_required
+def history():
+    conn = get_db()
+    conditions, params, filters = ledger_filters(request.args)
+    
+    # キーセット方式のページ送り：前のページの最後の (created_at, tx_id) より古いものを取得
+    cursor = _parse_history_cursor(request.args.get('cursor', ''))
+    if cursor:
+        conditions.append('(st.created_at, st.tx_id) < (?, ?)')
+        params.extend(cursor)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    
+    sql = f'''
+        SELECT st.*, i.name as item_name, i.unit, u.name as user_name
+        FROM {{ledger}} st
+        JOIN ITEMS i ON st.item_id = i.item_id
+        JOIN USERS u ON st.user_id = u.user_id
+        {where}
+        ORDER BY st.created_at DESC, st.tx_id DESC
+        LIMIT ?
+    '''
+    transactions = conn.execute(sql.format(ledger='STOCK_TRANSACTIONS'),
+                                params + [HISTORY_PAGE_SIZE + 1]).fetchall()
+    
+    # 1ページに足りなければ、アーカイブした月を新しい順にさかのぼる
+    if len(transactions) <= HISTORY_PAGE_SIZE:
+        first_month, last_month = _filter_month_bounds(filters)
+        if cursor:
+            last_month = min(last_month or cursor[0][:7], cursor[0][:7])
+        for month, path in archived_months(conn, first_month, last_month, newest_first=True):
+            with attach_archive(conn, month, path) as schema:
+                transactions += conn.execute(sql.format(ledger=f'{schema}.STOCK_TRANSACTIONS'),
+                                             params + [HISTORY_PAGE_SIZE + 1 - len(transactions)]).fetchall()
+            if len(transactions) > HISTORY_PAGE_SIZE:
+                break
+    
+    next_cursor = None
+    if len(transactions) > HISTORY_PAGE_SIZE:
+        transactions = transactions[:HISTORY_PAGE_SIZE]
+        last = transactions[-1]
+        next_cursor = f"{last['created_at']}|{last['tx_id']}"
+    next_url = url_for('history', cursor=next_cursor, **filters) if next_cursor else None
+    
+    # 「もっと見る」からの読み込みでは一覧部分だけを返す
+    if request.args.get('partial'):
+        return render_template('history_items.html', transactions=transactions, next_url=next_url)
+    
+    items = conn.execute('SELECT item_id, name FROM ITEMS ORDER BY display_order, item_id').fetchall()
+    users = conn.execute('SELECT user_id, name FROM USERS ORDER BY user_id').fetchall()
+    return render_template('history.html', transactions=transactions, next_url=next_url,
+                           filters=filters, items=items, users=users, reasons=STOCK_REASONS)
+
+# 履歴の出力（CSV / NDJSON、店主のみ）
+# 全件を読み込まずに fetchmany で少しずつ取り出し、そのままレスポンスに流す
+EXPORT_COLUMNS = ('tx_id', 'created_at', 'item_id', 'item_name', 'unit', 'quantity_delta',
+                  'reason', 'note', 'user_id', 'user_name')
+EXPORT_CHUNK_SIZE = 500
+
+def _fetch_in_chunks(cursor):
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        yield rows
+
+def iter_ledger_rows(conn, conditions, params, filters=None):
+    """古い順に履歴を読む（期間がアーカイブ済みの月にかかっていれば、その月のファイルから先に読む）"""
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    sql = f'''
+        SELECT st.tx_id, st.created_at, st.item_id, i.name as item_name, i.unit,
+               st.quantity_delta, st.reason, st.note, st.user_id, u.name as user_name
+        FROM {{ledger}} st
+        LEFT JOIN ITEMS i ON st.item_id = i.item_id
+        LEFT JOIN USERS u ON st.user_id = u.user_id
+        {where}
+        ORDER BY st.created_at, st.tx_id
+    '''
+    for month, path in archived_months(conn, *_filter_month_bounds(filters or {})):
+        with attach_archive(conn, month, path) as schema:
+            yield from _fetch_in_chunks(conn.execute(sql.format(ledger=f'{schema}.STOCK_TRANSACTIONS'), params))
+    yield from _fetch_in_chunks(conn.execute(sql.format(ledger='STOCK_TRANSACTIONS'), params))
+
+def _csv_chunks(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Excel で文字化けしないよう BOM を付ける
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def _ndjson_chunks(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+
+@app.route('/export_transactions')
+@owner_required
+def export_transactions():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        export_format = 'csv'
+    conditions, params, filters = ledger_filters(request.args)
+    
+    # ?background=1 ならジョブとして書き出し、終わったら /jobs からダウンロードする
+    if request.args.get('background'):
+        job_id = enqueue_job(get_db(), 'export_transactions',
+                             {'format': export_format, 'filters': filters}, user_id=session['user_id'])
+        return _action_result(True, '履歴の書き出しを登録しました。完了したらジョブ一覧からダウンロードできます',
+                              status=202, endpoint='jobs', job_id=job_id,
+                              status_url=url_for('api_job', job_id=job_id))
+    
+    @stream_with_context
+    def generate():
+        chunks = iter_ledger_rows(get_db(), conditions, params, filters)
+        if export_format == 'csv':
+            yield from _csv_chunks(chunks)
+        else:
+            yield from _ndjson_chunks(chunks)
+    
+    filename = f"stock_ledger_{datetime.now().strftime('%Y%m%d')}.{export_format}"
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# 品目削除（店主のみ・論理削除）
+@app.route('/delete_item/<int:item_id>', methods=['POST'])
+@owner_required
+def delete_item(item_id):
+    conn = get_db()
+    
+    # 品目名を取得（メッセージ用）
+    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
+    
+    if not item:
+        return _action_result(False, '品目が見つかりませんでした', 404)
+    
+    # 論理削除（is_active を 0 に設定）。trashed_at はゴミ箱の整理に使う
+    conn.execute('UPDATE ITEMS SET is_active = 0, trashed_at = ? WHERE item_id = ?',
+                 (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item_id))
+    conn.commit()
+    bump_data_version()
+    return _action_result(True, f'品目「{item["name"]}」を削除しました', item_id=item_id)
 
 # ゴミ箱（削除済み品目一覧・店主のみ）
 @app.route('/trash')
@@ -334,9 +2395,8 @@ def trash():
         FROM ITEMS i
         LEFT JOIN SUPPLIERS s ON i.supplier_id = s.supplier_id
         WHERE i.is_active = 0
-        ORDER BY i.updated_at DESC
+        ORDER BY i.trashed_at DESC
     ''').fetchall()
-    conn.close()
     
     return render_template('trash.html', items=deleted_items)
 
@@ -347,18 +2407,18 @@ def restore_item(item_id):
     conn = get_db()
     
     # 品目名を取得（メッセージ用）
-    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
+    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ? AND is_active = 0', (item_id,)).fetchone()
     
     if item:
         # 復元（is_active を 1 に設定）
-        conn.execute('UPDATE ITEMS SET is_active = 1, updated_at = ? WHERE item_id = ?',
+        conn.execute('UPDATE ITEMS SET is_active = 1, trashed_at = NULL, updated_at = ? WHERE item_id = ?',
                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item_id))
         conn.commit()
+        bump_data_version()
         flash(f'品目「{item["name"]}」を復元しました', 'success')
     else:
         flash('品目が見つかりませんでした', 'error')
     
-    conn.close()
     return redirect(url_for('trash'))
 
 # 品目完全削除（ゴミ箱から完全に削除・店主のみ）
@@ -368,73 +2428,216 @@ def permanent_delete(item_id):
     conn = get_db()
     
     # 品目名を取得（メッセージ用）
-    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
+    item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ? AND is_active IN (0, -1)', (item_id,)).fetchone()
     
     if item:
-        # 完全削除（物理削除）
-        conn.execute('DELETE FROM ITEMS WHERE item_id = ?', (item_id,))
-        conn.commit()
+        # 完全削除（履歴・通知・集計も一緒に消す）
+        purge_items(conn, claim_trash_items(conn, item_ids=[item_id]))
+        bump_data_version()
         flash(f'品目「{item["name"]}」を完全に削除しました', 'info')
     else:
         flash('品目が見つかりませんでした', 'error')
     
-    conn.close()
     return redirect(url_for('trash'))
-# 統計・レポート
-@app.route('/statistics')
-@login_required
-def statistics():
-    conn = get_db()
+
+# ゴミ箱の整理
+# 完全に削除する品目は、先に is_active = -1（削除処理中）にして復元や再選択の対象から外し、
+# 履歴（アーカイブ済みの月を含む）・通知・集計などを PURGE_BATCH_SIZE 行ずつ別々のトランザクションで消してから、
+# 最後に品目を消す。消す行のキーは先に読んでおくので（WAL なので読み取りは書き込みを止めない）、
+# 書き込みロックを持つのは主キーでの削除の間だけ。途中で止まっても、次の整理で続きから消す。
+PURGE_TABLES = (  # (テーブル, 主キーの列)
+    ('STOCK_TRANSACTIONS', ('tx_id',)),
+    ('NOTIFICATIONS', ('notification_id',)),
+    ('STOCK_DAILY_ROLLUP', ('day', 'item_id')),
+    ('ITEM_BALANCE_SNAPSHOTS', ('item_id', 'tx_id')),
+    ('ITEM_FORECAST', ('item_id',)),
+)
+
+def claim_trash_items(conn, days=None, item_ids=None):
+    """ゴミ箱に days 日より長くある品目（または item_ids）を削除処理中にして、途中で止まっていた品目と合わせて返す"""
+    if item_ids is not None:
+        marks = ','.join('?' * len(item_ids))
+        sql = f'UPDATE ITEMS SET is_active = -1 WHERE item_id IN ({marks}) AND is_active IN (0, -1) RETURNING item_id'
+        params = list(item_ids)
+    else:
+        sql = 'UPDATE ITEMS SET is_active = -1 WHERE (is_active = 0 AND trashed_at < ?) OR is_active = -1 RETURNING item_id'
+        params = [(datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')]
+    return sorted(row[0] for row in write_transaction(conn, lambda conn: conn.execute(sql, params).fetchall()))
+
+def _delete_item_rows(conn, table, key_columns, item_ids, on_batch=None):
+    """table の item_ids の行を PURGE_BATCH_SIZE 行ずつ消し、消した行数を返す"""
+    keys = conn.execute(f'''
+        SELECT {', '.join(key_columns)} FROM {table}
+        WHERE item_id IN ({','.join('?' * len(item_ids))})
+    ''', item_ids).fetchall()
+    where = ' AND '.join(f'{column} = ?' for column in key_columns)
+    batch_size = app.config['PURGE_BATCH_SIZE']
+    for start in range(0, len(keys), batch_size):
+        batch = [tuple(key) for key in keys[start:start + batch_size]]
+        def delete(conn):
+            conn.executemany(f'DELETE FROM {table} WHERE {where}', batch)
+            if on_batch is not None:
+                on_batch(conn, len(batch))
+        write_transaction(conn, delete)
+        time.sleep(app.config['PURGE_BATCH_PAUSE'])
+    return len(keys)
+
+def purge_items(conn, item_ids, progress=None):
+    """削除処理中の品目と付随する行を消し、テーブルごとの削除行数を返す"""
+    rows = {table: 0 for table, _ in PURGE_TABLES}
+    rows['ARCHIVED_TRANSACTIONS'] = 0
+    rows['ITEMS'] = 0
+    if not item_ids:
+        return rows
+    months = archived_months(conn)
+    steps = len(months) + len(PURGE_TABLES) + 1
     
-    # パラメータ取得（月選択・期間選択）
-    selected_period = request.args.get('period', 'current_month')  # current_month, 3months, 6months, 9months, 1year
-    selected_month = request.args.get('month', '')  # 2026-02 形式
-    
-    # 期間の計算
-    if selected_period == 'current_month':
-        start_date = "date('now', 'start of month')"
-        period_label = "今月"
-    elif selected_period == '3months':
-        start_date = "date('now', '-3 months')"
-        period_label = "過去3ヶ月"
-    elif selected_period == '6months':
-        start_date = "date('now', '-6 months')"
-        period_label = "過去6ヶ月"
-    elif selected_period == '9months':
-        start_date = "date('now', '-9 months')"
-        period_label = "過去9ヶ月"
-    elif selected_period == '1year':
-        start_date = "date('now', '-1 year')"
-        period_label = "過去1年"
-    elif selected_month:
+    for n, (month, path) in enumerate(months):
+        if progress is not None:
+            progress(n / steps, f'アーカイブ {month}')
+        with attach_archive(conn, month, path) as schema:
+            rows['ARCHIVED_TRANSACTIONS'] += _delete_item_rows(
+                conn, f'{schema}.STOCK_TRANSACTIONS', ('tx_id',), item_ids,
+                on_batch=lambda conn, count: conn.execute(
+                    'UPDATE ARCHIVED_MONTHS SET tx_count = tx_count - ? WHERE month = ?', (count, month)))
+    for n, (table, key_columns) in enumerate(PURGE_TABLES, start=len(months)):
+        if progress is not None:
+            progress(n / steps, table)
+        rows[table] += _delete_item_rows(conn, table, key_columns, item_ids)
+    
+    # 整理中に在庫が動いて履歴が増えた品目は残し、次の整理で消す
+    marks = ','.join('?' * len(item_ids))
+    rows['ITEMS'] = write_transaction(conn, lambda conn: conn.execute(f'''
+        DELETE FROM ITEMS
+        WHERE item_id IN ({marks}) AND is_active = -1
+        AND NOT EXISTS (SELECT 1 FROM STOCK_TRANSACTIONS st WHERE st.item_id = ITEMS.item_id)
+    ''', item_ids).rowcount)
+    return rows
+
+def reclaim_space(conn):
+    """空きページを VACUUM_STEP_PAGES ずつファイルから切り詰め、切り詰めたページ数を返す
+    
+    auto_vacuum = INCREMENTAL のデータベースだけが対象（古いデータベースは VACUUM ジョブで切り替わる）。
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    step = max(int(app.config['VACUUM_STEP_PAGES']), 1)
+    freed = 0
+    while True:
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if before == 0:
+            break
+        # execute() では incremental_vacuum が1ステップ（1ページ）しか進まないので、
+        # executescript() で最後まで実行する（executescript は開いているトランザクションを先にコミットする）
+        conn.executescript(f'PRAGMA incremental_vacuum({step});')
+        after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        freed += before - after
+        if before - after <= 1 < before:
+            app.logger.warning('incremental_vacuum が %d ページしか切り詰めませんでした（空き %d ページ）',
+                               before - after, before)
+            break
+        if after == 0:
+            break
+        time.sleep(app.config['PURGE_BATCH_PAUSE'])  # 1回分（VACUUM_STEP_PAGES ページ）ごとに他の書き込みを通す
+    # WAL の内容をデータベースのファイルに書き戻して、切り詰めたサイズをファイルに反映する
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return freed
+
+def purge_trash(conn, days=None, progress=None):
+    """ゴミ箱に days 日（省略時は TRASH_RETENTION_DAYS）より長くある品目を完全に削除して、空いた領域を返す"""
+    days = app.config['TRASH_RETENTION_DAYS'] if days is None else days
+    database = conn.database
+    bytes_before = os.path.getsize(database)
+    item_ids = claim_trash_items(conn, days=days)
+    rows = {}
+    chunk_size = app.config['PURGE_BATCH_SIZE']
+    for start in range(0, len(item_ids), chunk_size):
+        for table, count in purge_items(conn, item_ids[start:start + chunk_size], progress).items():
+            rows[table] = rows.get(table, 0) + count
+    if item_ids:
+        bump_data_version()
+    
+    if progress is not None:
+        progress(0.95, '空き領域の切り詰め')
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    freed_pages = reclaim_space(conn)
+    bytes_after = os.path.getsize(database)
+    return {
+        'days': days,
+        'items': rows.get('ITEMS', 0),
+        'rows': rows,
+        'freed_pages': freed_pages,
+        'bytes_reclaimed': max(bytes_before - bytes_after, 0),
+        'file_bytes': bytes_after,
+        'free_bytes': conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size,
+        'incremental_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2,
+    }
+
+@app.route('/purge_trash', methods=['POST'])
+@owner_required
+def purge_trash_request():
+    days = request.form.get('days', app.config['TRASH_RETENTION_DAYS'], type=int)
+    if days is None or days < 0:
+        return _action_result(False, '日数は0以上で指定してください', status=400, endpoint='trash')
+    job_id = enqueue_job(get_db(), 'purge_trash', {'days': days}, user_id=session['user_id'])
+    return _action_result(True, f'{days}日より前にゴミ箱に入れた品目の整理を登録しました', status=202,
+                          endpoint='jobs', job_id=job_id, status_url=url_for('api_job', job_id=job_id))
+# 統計・レポート
+STATISTICS_PERIODS = {
+    'current_month': (0, '今月'),
+    '3months': (3, '過去3ヶ月'),
+    '6months': (6, '過去6ヶ月'),
+    '9months': (9, '過去9ヶ月'),
+    '1year': (12, '過去1年'),
+}
+
+def _months_ago(today, months):
+    """today から months ヶ月前の日付（月末は丸める）。0 なら今月1日"""
+    if months == 0:
+        return today.replace(day=1)
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    month += 1
+    return today.replace(year=year, month=month, day=min(today.day, calendar.monthrange(year, month)[1]))
+
+def statistics_range(selected_period, selected_month):
+    """期間の指定から (期間, 月, 開始日, 終了日(含まない), 表示名) を返す"""
+    if selected_month and not MONTH_PATTERN.match(selected_month):
+        selected_month = ''
+    if selected_month and selected_period not in STATISTICS_PERIODS:
         # 特定の月が選択された場合
-        start_date = f"date('{selected_month}-01')"
-        period_label = selected_month.replace('-', '年') + '月'
-    else:
-        start_date = "date('now', 'start of month')"
-        period_label = "今月"
+        start_day, end_day = month_range(selected_month)
+        return '', selected_month, start_day, end_day, selected_month.replace('-', '年') + '月'
+    
+    if selected_period not in STATISTICS_PERIODS:
+        selected_period = 'current_month'
+    months, period_label = STATISTICS_PERIODS[selected_period]
+    start_day = _months_ago(date.today(), months).isoformat()
+    return selected_period, '', start_day, '9999-12-31', period_label
+
+def load_statistics(conn, today, start_day, end_day):
+    """統計画面の集計をまとめて実行する（履歴テーブルではなく日別集計だけを読む）"""
     
     # 利用可能な月のリスト取得（過去12ヶ月）
     available_months = conn.execute('''
-        SELECT DISTINCT strftime('%Y-%m', created_at) as month
-        FROM STOCK_TRANSACTIONS
-        WHERE created_at >= date('now', '-12 months')
+        SELECT DISTINCT substr(day, 1, 7) as month
+        FROM STOCK_DAILY_ROLLUP
+        WHERE day >= ?
         ORDER BY month DESC
-    ''').fetchall()
+    ''', (_months_ago(today, 12).isoformat(),)).fetchall()
     
     # 1. 月別使用量（過去6ヶ月）
     monthly_usage = conn.execute('''
         SELECT 
-            strftime('%Y-%m', st.created_at) as month,
+            substr(r.day, 1, 7) as month,
             i.name as item_name,
-            SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as usage
-        FROM STOCK_TRANSACTIONS st
-        JOIN ITEMS i ON st.item_id = i.item_id
-        WHERE st.created_at >= date('now', '-6 months')
-        AND st.reason IN ('使用', '廃棄')
+            SUM(r.used) as usage
+        FROM STOCK_DAILY_ROLLUP r
+        JOIN ITEMS i ON r.item_id = i.item_id
+        WHERE r.day >= ?
+        AND r.usage_tx_count > 0
         GROUP BY month, i.name
         ORDER BY month DESC
-    ''').fetchall()
+    ''', (_months_ago(today, 6).isoformat(),)).fetchall()
     
     # 2. カテゴリー別在庫割合
     category_stock = conn.execute('''
@@ -449,84 +2652,45 @@ def statistics():
     ''').fetchall()
     
     # 3. よく使う品目ランキング（選択期間）
-    if selected_month:
-        # 特定の月
-        top_items_query = f'''
-            SELECT 
-                i.name as item_name,
-                i.unit,
-                SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-                COUNT(*) as transaction_count
-            FROM STOCK_TRANSACTIONS st
-            JOIN ITEMS i ON st.item_id = i.item_id
-            WHERE strftime('%Y-%m', st.created_at) = '{selected_month}'
-            AND st.reason IN ('使用', '廃棄')
-            GROUP BY i.item_id, i.name, i.unit
-            ORDER BY total_usage DESC
-            LIMIT 10
-        '''
-    else:
-        top_items_query = f'''
+    top_items = conn.execute('''
+        SELECT 
+            i.name as item_name,
+            i.unit,
+            SUM(r.used) as total_usage,
+            SUM(r.usage_tx_count) as transaction_count
+        FROM STOCK_DAILY_ROLLUP r
+        JOIN ITEMS i ON r.item_id = i.item_id
+        WHERE r.day >= ? AND r.day < ?
+        AND r.usage_tx_count > 0
+        GROUP BY i.item_id, i.name, i.unit
+        ORDER BY total_usage DESC
+        LIMIT 10
+    ''', (start_day, end_day)).fetchall()
+    
+    # 3-2. 単位ごとの使用量ランキング（上位5件をウィンドウ関数でまとめて取得）
+    units_ranking = {}
+    unit_rows = conn.execute('''
+        SELECT item_name, unit, total_usage, transaction_count
+        FROM (
             SELECT 
                 i.name as item_name,
                 i.unit,
-                SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-                COUNT(*) as transaction_count
-            FROM STOCK_TRANSACTIONS st
-            JOIN ITEMS i ON st.item_id = i.item_id
-            WHERE st.created_at >= {start_date}
-            AND st.reason IN ('使用', '廃棄')
+                SUM(r.used) as total_usage,
+                SUM(r.usage_tx_count) as transaction_count,
+                ROW_NUMBER() OVER (PARTITION BY i.unit ORDER BY SUM(r.used) DESC) as rn
+            FROM STOCK_DAILY_ROLLUP r
+            JOIN ITEMS i ON r.item_id = i.item_id
+            WHERE r.day >= ? AND r.day < ?
+            AND r.usage_tx_count > 0
+            AND i.unit IN (SELECT unit FROM ITEMS WHERE is_active = 1 AND unit IS NOT NULL)
             GROUP BY i.item_id, i.name, i.unit
-            ORDER BY total_usage DESC
-            LIMIT 10
-        '''
-    
-    top_items = conn.execute(top_items_query).fetchall()
+        )
+        WHERE rn <= 5
+        ORDER BY unit, rn
+    ''', (start_day, end_day)).fetchall()
     
-    # 3-2. 単位ごとの使用量ランキング
-    units_ranking = {}
-    all_units = conn.execute('SELECT DISTINCT unit FROM ITEMS WHERE is_active = 1 AND unit IS NOT NULL').fetchall()
-    
-    for unit_row in all_units:
-        unit = unit_row['unit']
-        
-        if selected_month:
-            items_query = f'''
-                SELECT 
-                    i.name as item_name,
-                    i.unit,
-                    SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-                    COUNT(*) as transaction_count
-                FROM STOCK_TRANSACTIONS st
-                JOIN ITEMS i ON st.item_id = i.item_id
-                WHERE strftime('%Y-%m', st.created_at) = '{selected_month}'
-                AND st.reason IN ('使用', '廃棄')
-                AND i.unit = ?
-                GROUP BY i.item_id, i.name, i.unit
-                ORDER BY total_usage DESC
-                LIMIT 5
-            '''
-        else:
-            items_query = f'''
-                SELECT 
-                    i.name as item_name,
-                    i.unit,
-                    SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-                    COUNT(*) as transaction_count
-                FROM STOCK_TRANSACTIONS st
-                JOIN ITEMS i ON st.item_id = i.item_id
-                WHERE st.created_at >= {start_date}
-                AND st.reason IN ('使用', '廃棄')
-                AND i.unit = ?
-                GROUP BY i.item_id, i.name, i.unit
-                ORDER BY total_usage DESC
-                LIMIT 5
-            '''
-        
-        items = conn.execute(items_query, (unit,)).fetchall()
-        
-        if items:
-            units_ranking[unit] = items
+    for row in unit_rows:
+        units_ranking.setdefault(row['unit'], []).append(row)
     
     # 4. 在庫アラート（閾値120%以下）
     low_stock_items = conn.execute('''
@@ -542,152 +2706,743 @@ def statistics():
         ORDER BY percentage ASC
     ''').fetchall()
     
+    # 4-2. 在庫切れ予測（使用ペースから在庫がもつ日数の短い順）
+    stockout_forecast = []
+    for row in conn.execute('''
+        SELECT i.name as item_name, i.unit, i.current_quantity, i.min_threshold,
+               f.rate, f.day, f.day_used
+        FROM ITEM_FORECAST f
+        JOIN ITEMS i ON f.item_id = i.item_id
+        WHERE i.is_active = 1
+    '''):
+        forecast = item_forecast(row['current_quantity'], row['min_threshold'],
+                                 row['rate'], row['day'], row['day_used'], today)
+        if forecast is not None:
+            stockout_forecast.append(dict(forecast, item_name=row['item_name'], unit=row['unit'],
+                                          current_quantity=row['current_quantity']))
+    stockout_forecast.sort(key=lambda row: row['days_until_stockout'])
+    
     # 5. 期間の統計サマリー
-    if selected_month:
-        summary_query = f'''
-            SELECT 
-                COUNT(DISTINCT CASE WHEN quantity_delta > 0 THEN item_id END) as items_received,
-                COUNT(DISTINCT CASE WHEN quantity_delta < 0 THEN item_id END) as items_used,
-                SUM(CASE WHEN quantity_delta > 0 THEN quantity_delta ELSE 0 END) as total_received,
-                SUM(CASE WHEN quantity_delta < 0 THEN ABS(quantity_delta) ELSE 0 END) as total_used
-            FROM STOCK_TRANSACTIONS
-            WHERE strftime('%Y-%m', created_at) = '{selected_month}'
-        '''
-    else:
-        summary_query = f'''
-            SELECT 
-                COUNT(DISTINCT CASE WHEN quantity_delta > 0 THEN item_id END) as items_received,
-                COUNT(DISTINCT CASE WHEN quantity_delta < 0 THEN item_id END) as items_used,
-                SUM(CASE WHEN quantity_delta > 0 THEN quantity_delta ELSE 0 END) as total_received,
-                SUM(CASE WHEN quantity_delta < 0 THEN ABS(quantity_delta) ELSE 0 END) as total_used
-            FROM STOCK_TRANSACTIONS
-            WHERE created_at >= {start_date}
-        '''
+    monthly_summary = conn.execute('''
+        SELECT 
+            COUNT(DISTINCT CASE WHEN received > 0 THEN item_id END) as items_received,
+            COUNT(DISTINCT CASE WHEN removed > 0 THEN item_id END) as items_used,
+            SUM(received) as total_received,
+            SUM(removed) as total_used
+        FROM STOCK_DAILY_ROLLUP
+        WHERE day >= ? AND day < ?
+    ''', (start_day, end_day)).fetchone()
     
-    monthly_summary = conn.execute(summary_query).fetchone()
+    return {
+        'available_months': available_months,
+        'monthly_usage': monthly_usage,
+        'category_stock': category_stock,
+        'top_items': top_items,
+        'units_ranking': units_ranking,
+        'low_stock_items': low_stock_items,
+        'stockout_forecast': stockout_forecast[:20],
+        'monthly_summary': monthly_summary,
+    }
+
+# 統計結果のキャッシュ
+# キーは (データベース, 期間, 月, 今日の日付)。データバージョンが変わったもの（＝取引や品目の変更後）は
+# 使わずに集計し直す。件数の上限を超えたら最も古く使われたものから捨てる。
+class ResultCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
-    conn.close()
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+statistics_cache = ResultCache(max_entries=32)
+
+@app.route('/statistics')
+@login_required
+def statistics():
+    # パラメータ取得（月選択・期間選択）
+    selected_period, selected_month, start_day, end_day, period_label = statistics_range(
+        request.args.get('period', ''),  # current_month, 3months, 6months, 9months, 1year
+        request.args.get('month', ''))  # 2026-02 形式
+    today = date.today()
+    
+    key = (current_database(), selected_period, selected_month, today)
+    version = data_version()
+    context = statistics_cache.get(key, version)
+    if context is None:
+        context = load_statistics(get_db(), today, start_day, end_day)
+        statistics_cache.put(key, version, context)
     
     return render_template('statistics.html', 
-                         monthly_usage=monthly_usage,
-                         category_stock=category_stock,
-                         top_items=top_items,
-                         units_ranking=units_ranking,
-                         low_stock_items=low_stock_items,
-                         monthly_summary=monthly_summary,
-                         available_months=available_months,
+                         available_months=context['available_months'],
+                         monthly_usage=context['monthly_usage'],
+                         category_stock=context['category_stock'],
+                         top_items=context['top_items'],
+                         units_ranking=context['units_ranking'],
+                         low_stock_items=context['low_stock_items'],
+                         stockout_forecast=context['stockout_forecast'],
+                         forecast_lead_days=app.config['FORECAST_LEAD_DAYS'],
+                         monthly_summary=context['monthly_summary'],
                          selected_period=selected_period,
                          selected_month=selected_month,
                          period_label=period_label)
-    
-    # 1. 月別使用量（過去6ヶ月）
-    monthly_usage = conn.execute('''
-        SELECT 
-            strftime('%Y-%m', st.created_at) as month,
-            i.name as item_name,
-            SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as usage
-        FROM STOCK_TRANSACTIONS st
-        JOIN ITEMS i ON st.item_id = i.item_id
-        WHERE st.created_at >= date('now', '-6 months')
-        AND st.reason IN ('使用', '廃棄')
-        GROUP BY month, i.name
-        ORDER BY month DESC
+
+# 店舗横断レポート（複数店舗モード）
+# 各店舗のデータベースを別スレッドで並行して読み、在庫の合計と在庫不足の品目をまとめる。
+def load_store_summary(conn):
+    """1店舗分の単位ごとの在庫合計と、閾値を下回っている品目"""
+    totals = conn.execute('''
+        SELECT unit, COUNT(*) AS item_count, SUM(current_quantity) AS total_quantity
+        FROM ITEMS
+        WHERE is_active = 1
+        GROUP BY unit
+        ORDER BY unit
     ''').fetchall()
-    
-    # 2. カテゴリー別在庫割合
-    category_stock = conn.execute('''
-        SELECT 
-            c.name as category_name,
-            COUNT(i.item_id) as item_count,
-            SUM(i.current_quantity) as total_quantity
-        FROM CATEGORIES c
-        LEFT JOIN ITEMS i ON c.category_id = i.category_id AND i.is_active = 1
-        GROUP BY c.category_id, c.name
-        ORDER BY item_count DESC
+    low_stock = conn.execute('''
+        SELECT item_id, name, unit, current_quantity, min_threshold
+        FROM ITEMS
+        WHERE is_active = 1 AND current_quantity < min_threshold
+        ORDER BY current_quantity / NULLIF(min_threshold, 0), name
     ''').fetchall()
+    return {
+        'totals': [dict(row) for row in totals],
+        'low_stock': [dict(row) for row in low_stock],
+    }
+
+def _read_store_summary(database):
+    try:
+        conn = _acquire_connection(database)
+    except sqlite3.Error as e:
+        return {'error': str(e)}
+    try:
+        return load_store_summary(conn)
+    except sqlite3.Error as e:
+        return {'error': str(e)}
+    finally:
+        _release_connection(conn)
+
+def load_store_report():
+    """全店舗の集計（読めなかった店舗は error に理由を入れて残りの店舗だけで集計する）"""
+    stores = app.config['STORES']
+    workers = max(1, min(len(stores), app.config['STORE_REPORT_WORKERS']))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        summaries = dict(zip(stores, pool.map(_read_store_summary, stores.values())))
     
-    # 3. よく使う品目ランキング（今月）
-    top_items = conn.execute('''
-        SELECT 
-            i.name as item_name,
-            i.unit,
-            SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-            COUNT(*) as transaction_count
-        FROM STOCK_TRANSACTIONS st
-        JOIN ITEMS i ON st.item_id = i.item_id
-        WHERE st.created_at >= date('now', 'start of month')
-        AND st.reason IN ('使用', '廃棄')
-        GROUP BY i.item_id, i.name, i.unit
-        ORDER BY total_usage DESC
-        LIMIT 10
-    ''').fetchall()
+    totals = {}
+    low_stock = []
+    for store_id, summary in summaries.items():
+        for row in summary.get('totals', []):
+            total = totals.setdefault(row['unit'], {'unit': row['unit'], 'item_count': 0, 'total_quantity': 0})
+            total['item_count'] += row['item_count']
+            total['total_quantity'] += row['total_quantity']
+        low_stock.extend(dict(row, store_id=store_id) for row in summary.get('low_stock', []))
+    low_stock.sort(key=lambda row: (row['current_quantity'] / row['min_threshold'] if row['min_threshold'] else 0,
+                                    row['store_id'], row['name']))
+    return {
+        'stores': [dict(summary, store_id=store_id) for store_id, summary in summaries.items()],
+        'totals': sorted(totals.values(), key=lambda row: row['unit'] or ''),
+        'low_stock': low_stock,
+    }
+
+@app.route('/stores')
+@owner_required
+def store_report():
+    if not app.config['STORES']:
+        flash('複数店舗モードではありません（ZAIKO_STORES を設定してください）', 'error')
+        return redirect(url_for('index'))
+    return render_template('stores.html', report=load_store_report())
+
+@app.route('/api/stores/report')
+@owner_required
+def api_store_report():
+    if not app.config['STORES']:
+        return jsonify({'error': '複数店舗モードではありません'}), 404
+    return jsonify(load_store_report())
+
+@app.cli.command('migrate-stores')
+def migrate_stores():
+    """全店舗のデータベースを作成・マイグレーションする（初回アクセス時の待ちをなくす）"""
+    if not app.config['STORES']:
+        raise click.ClickException('ZAIKO_STORES が設定されていません')
+    for store_id, database in app.config['STORES'].items():
+        click.echo(f'{store_id}: {database}')
+        ensure_database(database)
+
+# バックグラウンドジョブ
+# 時間のかかる処理（書き出し・集計の作り直し・アーカイブ・VACUUM など）を JOBS 表に登録し、
+# 各ワーカープロセスのスレッドプールで実行する。表がデータベースにあるので外部のブローカーは不要で、
+# 同じホストの複数ワーカーが同時に見張っても、取り出しは BEGIN IMMEDIATE の中で1件ずつ行うので二重に実行しない。
+# ワーカーが落ちた場合は生存確認（heartbeat_at）が JOB_LEASE_SECONDS より古くなったジョブを再実行する。
+# ワーカーの外で実行する場合は ZAIKO_JOB_RUNNER=0 にして flask --app app run-jobs を別に起動する。
+JOB_KINDS = {}
+JOB_PROGRESS_INTERVAL = 0.5  # 進捗を JOBS 表に書く最短の間隔（秒）
+JOB_STATUS_LABELS = {'queued': '待機中', 'running': '実行中', 'done': '完了', 'failed': '失敗'}
+
+def job_kind(kind, label, max_attempts=3, manual=True):
+    """ジョブの種類を登録するデコレーター（manual=True なら /jobs の画面から登録できる）"""
+    def register(handler):
+        JOB_KINDS[kind] = {'handler': handler, 'label': label,
+                           'max_attempts': max_attempts, 'manual': manual}
+        return handler
+    return register
+
+def _job_now(seconds=0):
+    return (datetime.now() + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+def job_output_dir(database=None):
+    database = database or current_database()
+    return app.config['JOB_OUTPUT_DIR'] or os.path.join(os.path.dirname(os.path.abspath(database)), 'exports')
+
+def enqueue_job(conn, kind, params=None, user_id=None, run_after=None, schedule_key=None):
+    """ジョブを登録して job_id を返す（同じ schedule_key のジョブが既にあれば None）"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f'不明なジョブです: {kind}')
+    row = write_transaction(conn, lambda conn: conn.execute('''
+        INSERT INTO JOBS (kind, params, max_attempts, run_after, schedule_key, created_by)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (schedule_key) DO NOTHING
+        RETURNING job_id
+    ''', (kind, json.dumps(params or {}, ensure_ascii=False), JOB_KINDS[kind]['max_attempts'],
+          run_after or _job_now(), schedule_key, user_id)).fetchone())
+    # 見張りのスレッド自身が登録したジョブは、続けてそのまま取り出すので起こさない
+    if row and threading.current_thread() is not job_runner.thread:
+        job_runner.wakeup.set()
+    return row[0] if row else None
+
+def job_json(row):
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['label'] = JOB_KINDS[job['kind']]['label'] if job['kind'] in JOB_KINDS else job['kind']
+    job.pop('schedule_key', None)
+    return job
+
+def schedule_jobs(conn, now=None, scheduled=None):
+    """JOB_SCHEDULE の時刻を過ぎた今日の保守ジョブを登録する（登録済みなら何もしない）
     
-    # 3-2. 単位ごとの使用量ランキング
-    units_ranking = {}
-    all_units = conn.execute('SELECT DISTINCT unit FROM ITEMS WHERE is_active = 1 AND unit IS NOT NULL').fetchall()
+    scheduled に登録を済ませた schedule_key を記録し、次からは表に書きに行かない。
+    """
+    now = now or datetime.now()
+    today = now.date().isoformat()
+    if scheduled is None:
+        scheduled = set()
+    scheduled.difference_update([key for key in scheduled if not key.endswith('@' + today)])
+    for kind, at in app.config['JOB_SCHEDULE'].items():
+        schedule_key = f'{kind}@{today}'
+        if now.strftime('%H:%M') >= at and schedule_key not in scheduled:
+            enqueue_job(conn, kind, schedule_key=schedule_key)
+            scheduled.add(schedule_key)
+
+def claim_job(conn):
+    """実行できるジョブを1件取り出して running にする（なければ None）"""
+    now = _job_now()
+    # 実行できるジョブがないときは書き込みロックを取らない
+    if conn.execute("SELECT 1 FROM JOBS WHERE status = 'queued' AND run_after <= ? LIMIT 1", (now,)).fetchone() is None:
+        return None
+    return write_transaction(conn, lambda conn: conn.execute('''
+        UPDATE JOBS
+        SET status = 'running', attempts = attempts + 1, progress = 0, message = NULL,
+            started_at = ?, heartbeat_at = ?
+        WHERE job_id = (
+            SELECT job_id FROM JOBS
+            WHERE status = 'queued' AND run_after <= ?
+            ORDER BY run_after, job_id
+            LIMIT 1
+        )
+        RETURNING *
+    ''', (now, now, now)).fetchone())
+
+def recover_stale_jobs(conn):
+    """生存確認が途絶えた実行中のジョブを待機中に戻す（再試行の上限に達していれば失敗にする）"""
+    now = _job_now()
+    stale_before = _job_now(-app.config['JOB_LEASE_SECONDS'])
+    return write_transaction(conn, lambda conn: conn.execute('''
+        UPDATE JOBS
+        SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+            error = '実行中のワーカーが応答しなくなりました',
+            finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE ? END
+        WHERE status = 'running' AND heartbeat_at < ?
+    ''', (now, stale_before)).rowcount)
+
+def finish_job(conn, job, result=None, error=None):
+    """成功なら done、失敗なら再試行の待ち時間を置いて queued（上限に達していれば failed）にする"""
+    if error is None:
+        sql = '''UPDATE JOBS SET status = 'done', progress = 1, result = ?, error = NULL, finished_at = ?
+                 WHERE job_id = ?'''
+        params = (json.dumps(result, ensure_ascii=False, default=str), _job_now(), job['job_id'])
+    elif job['attempts'] < job['max_attempts']:
+        delay = app.config['JOB_RETRY_BACKOFF'] * (2 ** (job['attempts'] - 1))
+        sql = "UPDATE JOBS SET status = 'queued', error = ?, run_after = ? WHERE job_id = ?"
+        params = (error, _job_now(delay), job['job_id'])
+    else:
+        sql = "UPDATE JOBS SET status = 'failed', error = ?, finished_at = ? WHERE job_id = ?"
+        params = (error, _job_now(), job['job_id'])
+    write_transaction(conn, lambda conn: conn.execute(sql, params))
+
+class JobContext:
+    """実行中のジョブ。handler(job) は job.conn で作業し、job.progress() で進み具合を知らせる"""
+    def __init__(self, row, conn, status_conn):
+        self.job_id = row['job_id']
+        self.params = json.loads(row['params'])
+        self.user_id = row['created_by']
+        self.conn = conn
+        self.status_conn = status_conn  # 作業中のトランザクションと別に進捗を書くための接続
+        self._reported = 0.0
     
-    for unit_row in all_units:
-        unit = unit_row['unit']
-        items = conn.execute('''
-            SELECT 
-                i.name as item_name,
-                i.unit,
-                SUM(CASE WHEN st.quantity_delta < 0 THEN ABS(st.quantity_delta) ELSE 0 END) as total_usage,
-                COUNT(*) as transaction_count
-            FROM STOCK_TRANSACTIONS st
-            JOIN ITEMS i ON st.item_id = i.item_id
-            WHERE st.created_at >= date('now', 'start of month')
-            AND st.reason IN ('使用', '廃棄')
-            AND i.unit = ?
-            GROUP BY i.item_id, i.name, i.unit
-            ORDER BY total_usage DESC
-            LIMIT 5
-        ''', (unit,)).fetchall()
-        
-        if items:
-            units_ranking[unit] = items
+    def progress(self, fraction, message=None):
+        now = time.monotonic()
+        if now - self._reported < JOB_PROGRESS_INTERVAL and fraction < 1:
+            return
+        self._reported = now
+        write_transaction(self.status_conn, lambda conn: conn.execute(
+            'UPDATE JOBS SET progress = ?, message = COALESCE(?, message), heartbeat_at = ? WHERE job_id = ?',
+            (min(max(fraction, 0), 1), message, _job_now(), self.job_id)))
+
+def job_databases():
+    """ジョブを見張るデータベース（複数店舗モードでは作成済みの全店舗）"""
+    if app.config['STORES']:
+        return [database for database in app.config['STORES'].values() if os.path.exists(database)]
+    return [app.config['DATABASE']]
+
+class JobRunner:
+    """JOBS 表を見張り、実行待ちのジョブをスレッドプールで実行する（プロセスごとに1つ）"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.executor = None
+        self.running = {}    # job_id → データベース
+        self.conns = {}      # データベース → 見張り用の接続（見張りのスレッドだけが使う）
+        self.scheduled = {}  # データベース → 今日登録を済ませた定期ジョブの schedule_key
+        self.checked = {}    # データベース → 生存確認・回収を最後に行った時刻（time.monotonic()）
     
-    # 4. 在庫アラート（閾値80%以下）
-    low_stock_items = conn.execute('''
-        SELECT 
-            i.name as item_name,
-            i.current_quantity,
-            i.min_threshold,
-            i.unit,
-            ROUND((i.current_quantity * 100.0 / i.min_threshold), 1) as percentage
-        FROM ITEMS i
-        WHERE i.is_active = 1 
-        AND i.current_quantity <= (i.min_threshold * 1.2)
-        ORDER BY percentage ASC
-    ''').fetchall()
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                               thread_name_prefix='zaiko-job')
+            self.thread = threading.Thread(target=self._run, name='zaiko-job-runner', daemon=True)
+            self.thread.start()
     
-    # 5. 今月の統計サマリー
-    monthly_summary = conn.execute('''
-        SELECT 
-            COUNT(DISTINCT CASE WHEN quantity_delta > 0 THEN item_id END) as items_received,
-            COUNT(DISTINCT CASE WHEN quantity_delta < 0 THEN item_id END) as items_used,
-            SUM(CASE WHEN quantity_delta > 0 THEN quantity_delta ELSE 0 END) as total_received,
-            SUM(CASE WHEN quantity_delta < 0 THEN ABS(quantity_delta) ELSE 0 END) as total_used
-        FROM STOCK_TRANSACTIONS
-        WHERE created_at >= date('now', 'start of month')
-    ''').fetchone()
+    def _run(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception:
+                app.logger.exception('ジョブの確認に失敗しました')
+            self.wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+            self.wakeup.clear()
     
-    conn.close()
+    def _conn(self, database):
+        if database not in self.conns:
+            self.conns[database] = _connect(database)
+        return self.conns[database]
     
-    return render_template('statistics.html', 
-                         monthly_usage=monthly_usage,
-                         category_stock=category_stock,
-                         top_items=top_items,
-                         units_ranking=units_ranking,
-                         low_stock_items=low_stock_items,
-                         monthly_summary=monthly_summary)
+    def run_pending(self):
+        """予定のジョブを登録し、空いているスレッドの数だけジョブを取り出して実行に回す"""
+        for database in job_databases():
+            conn = self._conn(database)
+            schedule_jobs(conn, scheduled=self.scheduled.setdefault(database, set()))
+            now = time.monotonic()
+            if now - self.checked.get(database, -math.inf) >= app.config['JOB_HEARTBEAT_SECONDS']:
+                self.checked[database] = now
+                with self.lock:
+                    running = [job_id for job_id, db in self.running.items() if db == database]
+                if running:
+                    write_transaction(conn, lambda conn: conn.execute(
+                        f"UPDATE JOBS SET heartbeat_at = ? WHERE job_id IN ({','.join('?' * len(running))})",
+                        (_job_now(), *running)))
+                recover_stale_jobs(conn)
+            while len(self.running) < app.config['JOB_WORKERS']:
+                job = claim_job(conn)
+                if job is None:
+                    break
+                with self.lock:
+                    self.running[job['job_id']] = database
+                self.executor.submit(self._execute, database, job)
+    
+    def _execute(self, database, job):
+        _job_local.database = database
+        conn = _connect(database)
+        status_conn = _connect(database)
+        try:
+            handler = JOB_KINDS.get(job['kind'], {}).get('handler')
+            if handler is None:
+                raise ValueError(f'不明なジョブです: {job["kind"]}')
+            result = handler(JobContext(job, conn, status_conn))
+        except Exception as e:
+            app.logger.exception('ジョブ %s（%s）が失敗しました', job['job_id'], job['kind'])
+            if conn.in_transaction:
+                conn.rollback()
+            finish_job(status_conn, job, error=f'{type(e).__name__}: {e}')
+        else:
+            finish_job(status_conn, job, result=result)
+        finally:
+            conn.close()
+            status_conn.close()
+            _job_local.database = None
+            with self.lock:
+                self.running.pop(job['job_id'], None)
+            self.wakeup.set()
+    
+    def drain(self):
+        """実行待ちのジョブがなくなるまで実行する（run-jobs --once 用）"""
+        self.executor = self.executor or ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                                            thread_name_prefix='zaiko-job')
+        while True:
+            self.run_pending()
+            if not self.running:
+                return
+            self.wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+            self.wakeup.clear()
+
+job_runner = JobRunner()
+
+@app.before_request
+def start_job_runner():
+    # gunicorn の fork 後に各ワーカーで始めるよう、最初のリクエストで起動する
+    if app.config['JOB_RUNNER_ENABLED'] and job_runner.thread is None:
+        job_runner.start()
+
+# ジョブの種類
+@job_kind('export_transactions', '履歴の書き出し', manual=False)
+def export_transactions_job(job):
+    export_format = job.params.get('format', 'csv')
+    conditions, params, filters = ledger_filters(job.params.get('filters', {}))
+    directory = job_output_dir()
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(current_database()))[0]
+    filename = f'{stem}_job{job.job_id}.{export_format}'
+    
+    rows = 0
+    def counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            job.progress(0, f'{rows}件')
+            yield chunk
+    
+    chunks = counted(iter_ledger_rows(job.conn, conditions, params, filters))
+    temporary = os.path.join(directory, filename + '.tmp')
+    with open(temporary, 'w', encoding='utf-8', newline='') as f:
+        for text in (_csv_chunks(chunks) if export_format == 'csv' else _ndjson_chunks(chunks)):
+            f.write(text)
+    os.replace(temporary, os.path.join(directory, filename))
+    return {'file': filename, 'format': export_format, 'rows': rows,
+            'download_name': f"stock_ledger_{datetime.now().strftime('%Y%m%d')}.{export_format}"}
+
+@job_kind('statistics', '統計の事前集計')
+def statistics_job(job):
+    # このプロセスの統計キャッシュに各期間の集計を入れておく（他のワーカーは最初の表示時に集計する）
+    # 実行したプロセスにしか効かないので JOB_SCHEDULE には入れず、/jobs から手動で登録する
+    today = date.today()
+    version = data_version()
+    for n, period in enumerate(STATISTICS_PERIODS):
+        selected_period, selected_month, start_day, end_day, _ = statistics_range(period, '')
+        context = load_statistics(job.conn, today, start_day, end_day)
+        statistics_cache.put((current_database(), selected_period, selected_month, today), version, context)
+        job.progress((n + 1) / len(STATISTICS_PERIODS), STATISTICS_PERIODS[period][1])
+    return {'periods': len(STATISTICS_PERIODS)}
+
+@job_kind('rebuild_rollup', '日別集計の作り直し')
+def rebuild_rollup_job(job):
+    write_transaction(job.conn, rebuild_daily_rollup)
+    job.progress(0.5, '使用ペース')
+    write_transaction(job.conn, rebuild_item_forecast)
+    bump_data_version()
+    return {'rollup_rows': job.conn.execute('SELECT COUNT(*) FROM STOCK_DAILY_ROLLUP').fetchone()[0]}
+
+@job_kind('archive_ledger', '古い履歴のアーカイブ', max_attempts=1)
+def archive_ledger_job(job):
+    targets = archive_targets(job.conn, job.params.get('months'))
+    total = 0
+    for n, (month, count) in enumerate(targets):
+        job.progress(n / len(targets), f'{month}（{count}件）')
+        total += archive_month(job.conn, month)
+    if targets:
+        job.conn.execute('PRAGMA optimize')
+        bump_data_version()
+    return {'months': [month for month, _ in targets], 'archived': total}
+
+@job_kind('checkpoint_balances', '残高のチェックポイント')
+def checkpoint_balances_job(job):
+    return write_transaction(job.conn, create_balance_checkpoint)
+
+@job_kind('reconcile_stock', '在庫数と履歴の突き合わせ')
+def reconcile_stock_job(job):
+    if job.params.get('repair'):
+        result = write_transaction(job.conn, lambda conn: reconcile_stock(conn, repair=True))
+    else:
+        result = reconcile_stock(job.conn)
+    if result['repaired']:
+        bump_data_version()
+    return result
+
+@job_kind('optimize', '統計情報の更新（ANALYZE）')
+def optimize_job(job):
+    job.conn.execute('ANALYZE')
+    job.conn.execute('PRAGMA optimize')
+    job.progress(0.5, '古いジョブの削除')
+    # 保存期間を過ぎたジョブと書き出したファイルを消す
+    expired = job.conn.execute('''
+        SELECT job_id, result FROM JOBS
+        WHERE status IN ('done', 'failed') AND finished_at < ?
+    ''', (_job_now(-app.config['JOB_RETENTION_DAYS'] * 86400),)).fetchall()
+    for row in expired:
+        filename = (json.loads(row['result']) or {}).get('file') if row['result'] else None
+        if filename and os.path.exists(os.path.join(job_output_dir(), filename)):
+            os.remove(os.path.join(job_output_dir(), filename))
+    write_transaction(job.conn, lambda conn: conn.executemany(
+        'DELETE FROM JOBS WHERE job_id = ?', [(row['job_id'],) for row in expired]))
+    return {'deleted_jobs': len(expired)}
+
+@job_kind('purge_trash', 'ゴミ箱の整理')
+def purge_trash_job(job):
+    return purge_trash(job.conn, job.params.get('days'), job.progress)
+
+@job_kind('vacuum', 'データベースの最適化（VACUUM）', max_attempts=1)
+def vacuum_job(job):
+    size = os.path.getsize(current_database())
+    # 古いデータベースもこの VACUUM で auto_vacuum = INCREMENTAL に切り替える（以後はゴミ箱の整理で切り詰める）
+    job.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    job.conn.execute('VACUUM')
+    return {'bytes_before': size, 'bytes_after': os.path.getsize(current_database())}
+
+# ジョブの画面と API
+@app.route('/jobs', methods=['GET', 'POST'])
+@owner_required
+def jobs():
+    conn = get_db()
+    if request.method == 'POST':
+        kind = request.form.get('kind', '')
+        if kind not in JOB_KINDS or not JOB_KINDS[kind]['manual']:
+            return _action_result(False, '不明なジョブです', status=400, endpoint='jobs')
+        job_id = enqueue_job(conn, kind, user_id=session['user_id'])
+        job = conn.execute('SELECT * FROM JOBS WHERE job_id = ?', (job_id,)).fetchone()
+        return _action_result(True, f'「{JOB_KINDS[kind]["label"]}」を登録しました', status=202,
+                              endpoint='jobs', job=job_json(job))
+    
+    rows = conn.execute('SELECT * FROM JOBS ORDER BY job_id DESC LIMIT 50').fetchall()
+    return render_template('jobs.html', jobs=[job_json(row) for row in rows],
+                           job_kinds=JOB_KINDS, status_labels=JOB_STATUS_LABELS)
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def api_job(job_id):
+    row = get_db().execute('SELECT * FROM JOBS WHERE job_id = ?', (job_id,)).fetchone()
+    if row is None or (session.get('role') != 'owner' and row['created_by'] != session['user_id']):
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job_json(row))
+
+@app.route('/jobs/<int:job_id>/download')
+@owner_required
+def download_job_result(job_id):
+    row = get_db().execute('SELECT * FROM JOBS WHERE job_id = ?', (job_id,)).fetchone()
+    result = json.loads(row['result']) if row is not None and row['result'] else {}
+    if row is None or row['status'] != 'done' or not result.get('file'):
+        flash('書き出したファイルがありません', 'error')
+        return redirect(url_for('jobs'))
+    return send_from_directory(job_output_dir(), result['file'], as_attachment=True,
+                               download_name=result.get('download_name', result['file']))
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='実行待ちのジョブがなくなったら終了する')
+def run_jobs(once):
+    """バックグラウンドジョブをこのプロセスで実行する（ワーカーとは別に動かす場合）"""
+    if once:
+        job_runner.drain()
+        return
+    job_runner.start()
+    job_runner.thread.join()
+
+# 静的ファイル（flask --app app build-assets で作成）
+# static/dist/ に内容のハッシュ付きファイル名で出力し、manifest.json で元の名前と対応づける。
+# url_for('static', filename='css/style.css') は自動でハッシュ付きの URL になる。
+ASSET_FILES = ('css/style.css', 'js/main.js')
+ICON_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DIST_DIR = os.path.join(app.static_folder, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+_manifest_cache = {'mtime': None, 'data': {'assets': {}, 'icons': {}}}
+
+def asset_manifest():
+    """manifest.json を読み込む（更新されたときだけ読み直す）"""
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime
+    except OSError:
+        return {'assets': {}, 'icons': {}}
+    if _manifest_cache['mtime'] != mtime:
+        with open(MANIFEST_PATH, encoding='utf-8') as f:
+            _manifest_cache['data'] = json.load(f)
+        _manifest_cache['mtime'] = mtime
+    return _manifest_cache['data']
+
+def _write_manifest(manifest):
+    # 他のワーカーが読みかけのファイルを壊さないよう、書き終えてから置き換える
+    temp_path = MANIFEST_PATH + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, MANIFEST_PATH)
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = asset_manifest()['assets'].get(values['filename'], values['filename'])
+
+@app.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+    """ハッシュ付きファイルを長期キャッシュ付きで返す（圧縮済みファイルがあればそれを返す）"""
+    accepted = request.headers.get('Accept-Encoding', '')
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accepted and os.path.exists(os.path.join(DIST_DIR, filename + suffix)):
+            response = send_from_directory(DIST_DIR, filename + suffix, max_age=31536000)
+            response.headers['Content-Encoding'] = encoding
+            response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            break
+    if response is None:
+        response = send_from_directory(DIST_DIR, filename, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.template_global()
+def icon_variants(icon_path):
+    """カテゴリーアイコンの URL と、縮小版があれば WebP / JPEG の srcset を返す"""
+    icon = asset_manifest()['icons'].get(icon_path, {})
+    
+    def srcset(variants):
+        return ', '.join(f"{url_for('static', filename=path)} {density}x"
+                         for density, (size, path) in enumerate(variants, start=1))
+    
+    return {
+        'src': url_for('static', filename=icon['jpeg'][0][1] if icon else 'images/' + icon_path),
+        'webp_srcset': srcset(icon['webp']) if icon else None,
+        'jpeg_srcset': srcset(icon['jpeg']) if icon else None,
+    }
+
+def _hashed_name(path, content):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:10]}{ext}'
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{}:;,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+def minify_js(text):
+    # 文字列の中身を壊さないよう、行全体のコメントと行頭・行末の空白だけを取り除く
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def _write_compressed(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content, quality=11))
+
+def icon_source_path(icon_path):
+    """static/images/ 直下のアイコンの実際のパスを返す（static/images/ の外を指していれば None）"""
+    images_dir = os.path.realpath(os.path.join(app.static_folder, 'images'))
+    source = os.path.realpath(os.path.join(images_dir, icon_path))
+    if os.path.dirname(source) != images_dir or os.path.basename(icon_path) != icon_path:
+        return None
+    return source
+
+def build_icon_variants(icon_path):
+    """static/images/<icon_path> の縮小版（WebP / JPEG）を作り、manifest 用の情報を返す"""
+    source = icon_source_path(icon_path)
+    if Image is None or source is None or not os.path.exists(source):
+        return None
+    
+    variants = {'webp': [], 'jpeg': []}
+    with Image.open(source) as original:
+        original = ImageOps.exif_transpose(original).convert('RGB')
+        for size in app.config['ICON_SIZES']:
+            thumbnail = ImageOps.fit(original, (size, size), Image.LANCZOS)
+            for image_format, ext in (('webp', '.webp'), ('jpeg', '.jpg')):
+                buffer = io.BytesIO()
+                thumbnail.save(buffer, image_format.upper(), quality=80, optimize=True)
+                content = buffer.getvalue()
+                name = _hashed_name(f'images/{os.path.splitext(icon_path)[0]}.{size}{ext}', content)
+                os.makedirs(os.path.dirname(os.path.join(DIST_DIR, name)), exist_ok=True)
+                with open(os.path.join(DIST_DIR, name), 'wb') as f:
+                    f.write(content)
+                variants[image_format].append((size, 'dist/' + name))
+    return variants
+
+def add_icon_to_manifest(icon_path):
+    """アイコン1つ分の縮小版を作って manifest に追加する（カテゴリー追加時）"""
+    variants = build_icon_variants(icon_path)
+    if variants is None or not os.path.exists(MANIFEST_PATH):
+        return
+    manifest = dict(asset_manifest())
+    manifest['icons'] = dict(manifest['icons'], **{icon_path: variants})
+    _write_manifest(manifest)
+
+def build_assets():
+    """CSS / JS の縮小・圧縮とアイコンの縮小版を作り、manifest.json を書き出す"""
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest = {'assets': {}, 'icons': {}}
+    
+    for path in ASSET_FILES:
+        with open(os.path.join(app.static_folder, path), encoding='utf-8') as f:
+            text = f.read()
+        content = (minify_css(text) if path.endswith('.css') else minify_js(text)).encode('utf-8')
+        name = _hashed_name(path, content)
+        os.makedirs(os.path.dirname(os.path.join(DIST_DIR, name)), exist_ok=True)
+        _write_compressed(os.path.join(DIST_DIR, name), content)
+        manifest['assets'][path] = 'dist/' + name
+    
+    images_dir = os.path.join(app.static_folder, 'images')
+    for icon_path in sorted(os.listdir(images_dir)):
+        if icon_path.lower().endswith(ICON_EXTENSIONS):
+            variants = build_icon_variants(icon_path)
+            if variants:
+                manifest['icons'][icon_path] = variants
+    
+    _write_manifest(manifest)
+    return manifest
+
 # カテゴリー管理（店主のみ）
 @app.route('/categories')
 @owner_required
 def categories():
     conn = get_db()
     categories = conn.execute('SELECT * FROM CATEGORIES ORDER BY display_order, category_id').fetchall()
-    conn.close()
     return render_template('categories.html', categories=categories)
 
 # カテゴリー追加（店主のみ）
@@ -695,12 +3450,29 @@ def categories():
 @owner_required
 def add_category():
     name = request.form['name']
-    icon_filename = request.form.get('icon_filename', '')
+    # ファイル名だけを使う（../ などで static/images/ の外を指せないようにする）
+    icon_filename = os.path.basename(request.form.get('icon_filename', '').replace('\\', '/'))
+    
+    # 画像がアップロードされた場合は static/images/ に保存する
+    icon_file = request.files.get('icon_file')
+    if icon_file and icon_file.filename:
+        icon_filename = os.path.basename(icon_file.filename.replace('\\', '/'))
+        if not icon_filename.lower().endswith(ICON_EXTENSIONS):
+            flash('画像は JPEG または PNG を選択してください', 'error')
+            return redirect(url_for('categories'))
+        destination = icon_source_path(icon_filename)
+        if destination is None:
+            flash('画像のファイル名が正しくありません', 'error')
+            return redirect(url_for('categories'))
+        icon_file.save(destination)
+    
+    if icon_filename:
+        add_icon_to_manifest(icon_filename)
     
     conn = get_db()
     conn.execute('INSERT INTO CATEGORIES (name, icon_path) VALUES (?, ?)', (name, icon_filename))
     conn.commit()
-    conn.close()
+    bump_data_version()
     
     flash(f'カテゴリー「{name}」を追加しました', 'success')
     return redirect(url_for('categories'))
@@ -722,9 +3494,9 @@ def delete_category(category_id):
         if category:
             conn.execute('DELETE FROM CATEGORIES WHERE category_id = ?', (category_id,))
             conn.commit()
+            bump_data_version()
             flash(f'カテゴリー「{category["name"]}」を削除しました', 'success')
     
-    conn.close()
     return redirect(url_for('categories'))
 
 # 品目のカテゴリー変更（店主のみ）
@@ -735,15 +3507,617 @@ def change_category(item_id):
     
     conn = get_db()
     item = conn.execute('SELECT name FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
-    category = conn.execute('SELECT name FROM CATEGORIES WHERE category_id = ?', (new_category_id,)).fetchone()
+    category = conn.execute('SELECT category_id, name FROM CATEGORIES WHERE category_id = ?', (new_category_id,)).fetchone()
     
-    if item and category:
-        conn.execute('UPDATE ITEMS SET category_id = ? WHERE item_id = ?', (new_category_id, item_id))
-        conn.commit()
-        flash(f'「{item["name"]}」を「{category["name"]}」に移動しました', 'success')
+    if not (item and category):
+        return _action_result(False, '品目またはカテゴリーが見つかりませんでした', 404)
+    
+    conn.execute('UPDATE ITEMS SET category_id = ? WHERE item_id = ?', (new_category_id, item_id))
+    conn.commit()
+    bump_data_version()
+    return _action_result(True, f'「{item["name"]}」を「{category["name"]}」に移動しました',
+                          item_id=item_id, category_id=category['category_id'])
+
+# 日別集計の作り直し（flask --app app backfill-rollup）
+@app.cli.command('backfill-rollup')
+def backfill_rollup():
+    """既存の履歴から STOCK_DAILY_ROLLUP と使用ペースを作り直す"""
+    conn = _connect()
+    try:
+        with conn:
+            rebuild_daily_rollup(conn)
+            rebuild_item_forecast(conn)
+        count = conn.execute('SELECT COUNT(*) FROM STOCK_DAILY_ROLLUP').fetchone()[0]
+    finally:
+        conn.close()
+    bump_data_version()
+    print(f'日別集計を作り直しました（{count}行）')
+
+# 品目の一括登録（flask --app app import-items FILE）
+@app.cli.command('import-items')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='検証だけ行い、登録しない')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='1トランザクションで登録する行数')
+@click.option('--user-id', default=None, type=int, help='登録者（省略時は最初の店主）')
+def import_items_command(file, dry_run, chunk_size, user_id):
+    """CSV から品目と初期在庫を一括登録する"""
+    with open(file, 'rb') as f:
+        rows = read_import_csv(f.read())
+    
+    conn = _connect()
+    try:
+        if user_id is None:
+            owner = conn.execute("SELECT user_id FROM USERS WHERE role = 'owner' ORDER BY user_id LIMIT 1").fetchone()
+            user_id = owner['user_id'] if owner else None
+        started = time.perf_counter()
+        summary = import_items(conn, rows, user_id, dry_run=dry_run, chunk_size=chunk_size)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    if summary['imported']:
+        bump_data_version()
+    
+    for line, message in summary['errors']:
+        print(f'{line}行目: {message}')
+    if summary['new_suppliers']:
+        print('新しい仕入先: ' + ', '.join(summary['new_suppliers']))
+    if summary['new_categories']:
+        print('新しいカテゴリー: ' + ', '.join(summary['new_categories']))
+    if dry_run:
+        print(f'検証のみ: {summary["rows"]}行中 {summary["valid"]}行が登録可能です')
+    else:
+        print(f'{summary["rows"]}行中 {summary["imported"]}品目を登録しました（{elapsed:.2f}秒）')
+
+# 履歴のアーカイブ（flask --app app archive-ledger）
+@app.cli.command('archive-ledger')
+@click.option('--months', default=None, type=int, help='残す月数（省略時は ARCHIVE_HORIZON_MONTHS）')
+@click.option('--dry-run', is_flag=True, help='アーカイブする月と件数を表示するだけ')
+def archive_ledger(months, dry_run):
+    """古い月の履歴を月ごとのアーカイブファイルに移す"""
+    conn = _connect()
+    try:
+        targets = archive_targets(conn, months)
+        if not targets:
+            print(f'{archive_horizon(months)} より前の履歴はありません')
+            return
+        
+        total = 0
+        for month, count in targets:
+            if dry_run:
+                print(f'{month}: {count}件（{archive_filename(month)}）')
+                continue
+            started = time.perf_counter()
+            moved = archive_month(conn, month)
+            total += moved
+            print(f'{month}: {moved}件を {archive_filename(month)} に移しました（{time.perf_counter() - started:.1f}秒）')
+        if not dry_run:
+            conn.execute('PRAGMA optimize')
+            bump_data_version()
+            print(f'合計 {total}件をアーカイブしました（保存先: {archive_dir()}）')
+    finally:
+        conn.close()
+
+# 残高のチェックポイント（flask --app app checkpoint-balances、cron などで定期的に実行）
+@app.cli.command('checkpoint-balances')
+def checkpoint_balances():
+    """全品目の現在の残高をチェックポイントとして記録する"""
+    conn = _connect()
+    try:
+        started = time.perf_counter()
+        checkpoint = write_transaction(conn, create_balance_checkpoint)
+    finally:
+        conn.close()
+    if checkpoint is None:
+        print('前回のチェックポイント以降の取引はありません')
+    else:
+        print(f'tx_id {checkpoint["tx_id"]} までの {checkpoint["item_count"]}品目の残高を記録しました'
+              f'（{time.perf_counter() - started:.2f}秒）')
+
+# 在庫数と履歴の突き合わせ（flask --app app reconcile-stock）
+@app.cli.command('reconcile-stock')
+@click.option('--repair', is_flag=True, help='ずれている品目の在庫数を履歴の残高に合わせる')
+def reconcile_stock_command(repair):
+    """ITEMS の在庫数と履歴の残高がずれている品目を表示する"""
+    conn = _connect()
+    try:
+        started = time.perf_counter()
+        if repair:
+            result = write_transaction(conn, lambda conn: reconcile_stock(conn, repair=True))
+        else:
+            result = reconcile_stock(conn)
+    finally:
+        conn.close()
+    for row in result['drift']:
+        print(f'{row["item_id"]} {row["name"]}: 在庫数 {row["current_quantity"]:g} / '
+              f'履歴 {row["ledger_quantity"]:g}（差 {row["drift"]:+g} {row["unit"] or ""}）')
+    print(f'{result["checked_items"]}品目中 {len(result["drift"])}品目がずれています'
+          f'（{time.perf_counter() - started:.2f}秒）')
+    if result['repaired']:
+        bump_data_version()
+        print('在庫数を履歴の残高に合わせました')
+
+# ゴミ箱の整理（flask --app app purge-trash、cron などで定期的に実行してもよい）
+@app.cli.command('purge-trash')
+@click.option('--days', default=None, type=int, help='ゴミ箱に入れてからの日数（省略時は TRASH_RETENTION_DAYS）')
+@click.option('--dry-run', is_flag=True, help='対象の品目と履歴の件数を表示するだけ')
+def purge_trash_command(days, dry_run):
+    """ゴミ箱に長くある品目を履歴・通知・集計ごと完全に削除し、空いた領域を切り詰める"""
+    days = app.config['TRASH_RETENTION_DAYS'] if days is None else days
+    conn = _connect()
+    try:
+        if dry_run:
+            cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+            items = conn.execute('''
+                SELECT i.item_id, i.name, i.trashed_at,
+                       (SELECT COUNT(*) FROM STOCK_TRANSACTIONS st WHERE st.item_id = i.item_id) as tx_count
+                FROM ITEMS i
+                WHERE (i.is_active = 0 AND i.trashed_at < ?) OR i.is_active = -1
+                ORDER BY i.item_id
+            ''', (cutoff,)).fetchall()
+            for item in items:
+                print(f'{item["item_id"]} {item["name"]}（{item["trashed_at"]}）: 履歴 {item["tx_count"]}件')
+            print(f'{len(items)}品目が対象です（アーカイブ済みの履歴は含まない件数）')
+            return
+        started = time.perf_counter()
+        result = purge_trash(conn, days)
+    finally:
+        conn.close()
+    for table, count in result['rows'].items():
+        if count:
+            print(f'{table}: {count}行')
+    print(f'{result["items"]}品目を完全に削除しました（{time.perf_counter() - started:.2f}秒）')
+    print(f'{result["freed_pages"]}ページ（{result["bytes_reclaimed"]:,}バイト）を切り詰めました')
+    if not result['incremental_vacuum'] and result['free_bytes']:
+        print(f'空き領域 {result["free_bytes"]:,}バイトを返すには、一度 VACUUM ジョブを実行してください')
+
+# 同時更新の負荷試験（flask --app app stress-stock ITEM_ID）
+# 複数プロセス×複数スレッドから同じ品目を +1 し続け、
+# 在庫の増加量と追加された履歴の合計・件数が一致するか確認する。
+def _stress_worker(item_id, threads, updates, user_id):
+    def run():
+        conn = _connect()
+        try:
+            for _ in range(updates):
+                write_transaction(conn, lambda conn: apply_stock_movement(
+                    conn, item_id, 1, '棚卸し', 'stress-stock', user_id))
+        finally:
+            conn.close()
     
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+@app.cli.command('stress-stock')
+@click.argument('item_id', type=int)
+@click.option('--processes', default=4, show_default=True, help='同時に動かすプロセス数')
+@click.option('--threads', default=4, show_default=True, help='プロセスごとのスレッド数')
+@click.option('--updates', default=50, show_default=True, help='スレッドごとの更新回数')
+@click.option('--user-id', default=None, type=int, help='履歴に記録するユーザー（省略時は最初の店主）')
+def stress_stock(item_id, processes, threads, updates, user_id):
+    """1つの品目に同時に在庫更新を集中させ、更新の取りこぼしがないか確認する"""
+    conn = _connect()
+    item = conn.execute('SELECT current_quantity FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()
+    if item is None:
+        raise click.ClickException(f'品目 {item_id} が見つかりません')
+    if user_id is None:
+        owner = conn.execute("SELECT user_id FROM USERS WHERE role = 'owner' ORDER BY user_id LIMIT 1").fetchone()
+        user_id = owner['user_id'] if owner else None
+    before_quantity = item['current_quantity']
+    before_tx = conn.execute('SELECT COALESCE(MAX(tx_id), 0) FROM STOCK_TRANSACTIONS').fetchone()[0]
+    
+    started = time.perf_counter()
+    workers = [multiprocessing.Process(target=_stress_worker, args=(item_id, threads, updates, user_id))
+               for _ in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    elapsed = time.perf_counter() - started
+    
+    expected = processes * threads * updates
+    after_quantity = conn.execute('SELECT current_quantity FROM ITEMS WHERE item_id = ?', (item_id,)).fetchone()[0]
+    ledger = conn.execute('''
+        SELECT COUNT(*) as count, COALESCE(SUM(quantity_delta), 0) as total
+        FROM STOCK_TRANSACTIONS
+        WHERE item_id = ? AND tx_id > ?
+    ''', (item_id, before_tx)).fetchone()
     conn.close()
-    return redirect(url_for('index'))
+    bump_data_version()
+    
+    print(f'更新回数: {expected} / 履歴の件数: {ledger["count"]} / 履歴の合計: {ledger["total"]:g}')
+    print(f'在庫: {before_quantity:g} → {after_quantity:g}（増加 {after_quantity - before_quantity:g}）')
+    print(f'処理時間: {elapsed:.2f}秒 / スループット: {expected / elapsed:.0f}件/秒')
+    failed = [p for p in workers if p.exitcode != 0]
+    if failed or ledger['count'] != expected or after_quantity - before_quantity != ledger['total']:
+        raise SystemExit('NG: 在庫と履歴が一致しません')
+    print('OK: 在庫の増加量と履歴の合計が一致しました')
+
+# 負荷試験用のデータ生成（flask --app app generate-data OUTPUT）
+# シードを固定すれば同じデータベースが何度でも作れる。履歴は期間内に時系列順で並べ、
+# 在庫数は履歴の合計と一致させる。日別集計・使用ペースは最後にまとめて作る。
+GENERATE_CHUNK_SIZE = 50000
+GENERATE_UNITS = ('ｇ', 'kg', '個', '本', '袋', '箱', '枚', 'L')
+
+@app.cli.command('generate-data')
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--items', default=1000, show_default=True, help='品目数')
+@click.option('--categories', default=10, show_default=True, help='カテゴリー数（初期の5件を含む）')
+@click.option('--suppliers', default=20, show_default=True, help='仕入先数（初期の2件を含む）')
+@click.option('--users', default=10, show_default=True, help='ユーザー数（1人目が店主）')
+@click.option('--transactions', default=1000000, show_default=True, help='履歴の件数')
+@click.option('--days', default=365, show_default=True, help='履歴の期間（今日から遡る日数）')
+@click.option('--seed', default=1, show_default=True, help='乱数のシード')
+@click.option('--force', is_flag=True, help='OUTPUT が既にあれば削除して作り直す')
+def generate_data(output, items, categories, suppliers, users, transactions, days, seed, force):
+    """指定した規模の zaiko2 形式のデータベースを作る"""
+    if os.path.exists(output):
+        if not force:
+            raise click.ClickException(f'{output} は既に存在します（作り直す場合は --force）')
+        forget_database(output)  # 設定の DATABASE と同じファイルなら、起動時に開いた接続と作成済みの印が残っている
+        for suffix in ('', '-wal', '-shm', '.version'):
+            if os.path.exists(output + suffix):
+                os.remove(output + suffix)
+    
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    ensure_database(output)
+    
+    conn = _connect(output)
+    conn.execute('PRAGMA synchronous = OFF')
+    with conn:
+        conn.executemany('INSERT INTO USERS (name, role) VALUES (?, ?)',
+                         [(f'ユーザー{n}', 'owner' if n == 1 else 'staff') for n in range(1, users + 1)])
+        conn.executemany('INSERT INTO SUPPLIERS (name) VALUES (?)',
+                         [(f'仕入先{n}',) for n in range(3, suppliers + 1)])
+        conn.executemany('INSERT INTO CATEGORIES (name, display_order) VALUES (?, ?)',
+                         [(f'カテゴリー{n}', n) for n in range(6, categories + 1)])
+    user_ids = [row[0] for row in conn.execute('SELECT user_id FROM USERS')]
+    supplier_ids = [row[0] for row in conn.execute('SELECT supplier_id FROM SUPPLIERS')]
+    category_ids = [row[0] for row in conn.execute('SELECT category_id FROM CATEGORIES')]
+    
+    # 品目ごとの1日あたりの使用量を決め、よく使う品目ほど履歴が多くなるようにする
+    daily_usage = [rng.lognormvariate(1.5, 1.0) for _ in range(items)]
+    
+    start = datetime.now().replace(microsecond=0) - timedelta(days=days)
+    step = days * 86400 / max(transactions, 1)
+    cum_weights = list(itertools.accumulate(daily_usage))
+    balances = [0.0] * items
+    with conn:
+        for offset in range(0, transactions, GENERATE_CHUNK_SIZE):
+            numbers = range(offset, min(offset + GENERATE_CHUNK_SIZE, transactions))
+            picked = rng.choices(range(items), cum_weights=cum_weights, k=len(numbers))
+            reasons = rng.choices(STOCK_REASONS, (10, 80, 5, 5), k=len(numbers))
+            rows = []
+            for n, index, reason in zip(numbers, picked, reasons):
+                if n < items:
+                    index, reason = n, '棚卸し'  # 最初に全品目の初期在庫
+                    delta = round(daily_usage[index] * 30, 1)
+                elif reason == '入荷':
+                    delta = round(daily_usage[index] * rng.uniform(5, 12), 1)
+                elif reason == '棚卸し':
+                    delta = round(rng.uniform(-1, 1) * daily_usage[index], 1) or 1.0
+                else:
+                    delta = -round(daily_usage[index] * rng.uniform(0.2, 1.5), 1) or -1.0
+                    if balances[index] + delta < 0:  # 在庫が足りなければ先に入荷したことにする
+                        reason, delta = '入荷', round(daily_usage[index] * rng.uniform(5, 12), 1)
+                balances[index] += delta
+                created_at = (start + timedelta(seconds=int(n * step))).strftime('%Y-%m-%d %H:%M:%S')
+                # 品目は在庫数が決まってから item_id = index + 1 で作る
+                rows.append((index + 1, delta, reason, rng.choice(user_ids), created_at))
+            conn.executemany('''
+                INSERT INTO STOCK_TRANSACTIONS (item_id, quantity_delta, reason, note, user_id, created_at)
+                VALUES (?, ?, ?, '', ?, ?)
+            ''', rows)
+    
+    with conn:
+        conn.executemany('''
+            INSERT INTO ITEMS (item_id, name, unit, current_quantity, min_threshold, supplier_id, category_id,
+                               created_by, display_order, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(index + 1, f'品目{index + 1:05d}', rng.choice(GENERATE_UNITS), round(balances[index], 1),
+               round(daily_usage[index] * app.config['FORECAST_LEAD_DAYS'], 1),
+               rng.choice(supplier_ids), rng.choice(category_ids), user_ids[0], index,
+               start.strftime('%Y-%m-%d %H:%M:%S'), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+              for index in range(items)])
+        rebuild_daily_rollup(conn)
+        rebuild_item_forecast(conn)
+    conn.execute('ANALYZE')
+    conn.close()
+    
+    print(f'{output}: 品目 {items} / カテゴリー {categories} / 仕入先 {suppliers} / '
+          f'ユーザー {users} / 履歴 {transactions}件（{days}日分）')
+    print(f'作成時間: {time.perf_counter() - started:.1f}秒')
+
+# ベンチマーク（flask --app app benchmark）
+# テストクライアントで主要な画面を繰り返し表示し、レイテンシ（p50/p95/p99）・スループット・
+# 1リクエストあたりの SQL 文の数を JSON に保存する。--url / --gunicorn を指定すると
+# 複数プロセスから HTTP で負荷をかける（その場合 SQL 文の数は数えない）。
+BENCHMARK_ROUTES = [
+    ('index', 'GET', '/'),
+    ('api_inventory', 'GET', '/api/inventory'),
+    ('history', 'GET', '/history'),
+    ('history_deep', 'GET', '/history?cursor={cursor}'),
+    ('history_item', 'GET', '/history?item_id={item_id}'),
+    ('statistics', 'GET', '/statistics'),
+    ('statistics_1year', 'GET', '/statistics?period=1year'),
+    ('update_stock', 'POST', '/update_stock/{item_id}'),
+]
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = max(math.ceil(len(sorted_values) * percent / 100) - 1, 0)
+    return sorted_values[index]
+
+def _latency_summary(latencies, elapsed, queries=None, errors=0):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p95_ms': round(_percentile(latencies, 95) * 1000, 3) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+    if queries is not None:
+        summary['queries_per_request'] = round(sum(queries) / len(queries), 2) if queries else None
+        summary['max_queries'] = max(queries) if queries else None
+    return summary
+
+def _benchmark_request(rng, item_ids, cursor, method, path):
+    path = path.format(item_id=rng.choice(item_ids), cursor=cursor)
+    data = {'quantity_delta': rng.choice(('-1', '1')), 'reason': '棚卸し', 'note': 'benchmark'}
+    return path, (data if method == 'POST' else None)
+
+def _benchmark_client_run(base_url, method, path, count, item_ids, cursor, seed):
+    """HTTP で count 回リクエストし、(レイテンシのリスト, エラー数) を返す（別プロセスで実行）"""
+    import http.cookiejar
+    import urllib.parse
+    import urllib.request
+    
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    login = urllib.parse.urlencode({'name': 'benchmark', 'role': 'owner'}).encode()
+    opener.open(base_url + '/login', login).read()
+    
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    for _ in range(count):
+        url_path, data = _benchmark_request(rng, item_ids, cursor, method, path)
+        body = urllib.parse.urlencode(data).encode() if data else None
+        # 書き込みは JSON で受け取り、リダイレクト先の一覧画面まで計測しないようにする
+        request = urllib.request.Request(base_url + urllib.parse.quote(url_path, safe='/?=&|:'), body,
+                                         headers={'Accept': 'application/json'} if data else {})
+        started = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                response.read()
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+def _wait_for_server(base_url, timeout=30):
+    import urllib.request
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/login').read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException(f'{base_url} に接続できませんでした')
+
+@app.cli.command('benchmark')
+@click.option('--requests', 'count', default=200, show_default=True, help='経路ごとのリクエスト数')
+@click.option('--warmup', default=10, show_default=True, help='計測前に捨てるリクエスト数（経路ごと）')
+@click.option('--route', 'routes', multiple=True, help='計測する経路名（省略時はすべて）')
+@click.option('--no-cache', is_flag=True, help='毎回画面のキャッシュを捨てて計測する（テストクライアントのみ）')
+@click.option('--url', default=None, help='起動済みのサーバーに HTTP で負荷をかける（例: http://127.0.0.1:8000）')
+@click.option('--gunicorn', 'gunicorn_workers', default=0, help='gunicorn をこのワーカー数で起動して計測する')
+@click.option('--concurrency', default=4, show_default=True, help='HTTP で計測するときのクライアントのプロセス数')
+@click.option('--seed', default=1, show_default=True, help='品目選択の乱数のシード')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='結果を保存する JSON ファイル')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), default=None, help='比較する以前の結果 JSON')
+def benchmark(count, warmup, routes, no_cache, url, gunicorn_workers, concurrency, seed, output, compare):
+    """主要な経路のレイテンシ・スループット・SQL 文の数を計測する"""
+    selected = [route for route in BENCHMARK_ROUTES if not routes or route[0] in routes]
+    if not selected:
+        raise click.ClickException('経路名: ' + ', '.join(route[0] for route in BENCHMARK_ROUTES))
+    
+    conn = _connect()
+    item_ids = [row[0] for row in conn.execute('SELECT item_id FROM ITEMS WHERE is_active = 1')]
+    scale = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+             for table in ('ITEMS', 'CATEGORIES', 'SUPPLIERS', 'USERS', 'STOCK_TRANSACTIONS')}
+    owner = conn.execute("SELECT user_id, name FROM USERS WHERE role = 'owner' ORDER BY user_id LIMIT 1").fetchone()
+    # 深いページ用に、履歴の真ん中あたりをカーソルにする
+    middle = conn.execute('SELECT created_at, tx_id FROM STOCK_TRANSACTIONS WHERE tx_id <= ? ORDER BY tx_id DESC LIMIT 1',
+                          (scale['STOCK_TRANSACTIONS'] // 2 or 1,)).fetchone()
+    cursor = f"{middle['created_at']}|{middle['tx_id']}" if middle else ''
+    conn.close()
+    if not item_ids:
+        raise click.ClickException('品目がありません（generate-data でデータを作ってください）')
+    
+    server = None
+    if gunicorn_workers:
+        import subprocess
+        import sys
+        url = 'http://127.0.0.1:8765'
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-w', str(gunicorn_workers), '-b', '127.0.0.1:8765', 'app:app'],
+            cwd=app.root_path, env=dict(os.environ, ZAIKO_DATABASE=os.path.abspath(app.config['DATABASE']),
+                                        ZAIKO_JOB_RUNNER='0'))
+    
+    results = {}
+    try:
+        if url:
+            url = url.rstrip('/')
+            _wait_for_server(url)
+            with multiprocessing.Pool(concurrency) as pool:
+                for name, method, path in selected:
+                    pool.starmap(_benchmark_client_run,
+                                 [(url, method, path, max(warmup // concurrency, 1), item_ids, cursor, seed + n)
+                                  for n in range(concurrency)])
+                    per_client = max(count // concurrency, 1)
+                    started = time.perf_counter()
+                    runs = pool.starmap(_benchmark_client_run,
+                                        [(url, method, path, per_client, item_ids, cursor, seed + n)
+                                         for n in range(concurrency)])
+                    elapsed = time.perf_counter() - started
+                    results[name] = _latency_summary([value for latencies, _ in runs for value in latencies],
+                                                     elapsed, errors=sum(errors for _, errors in runs))
+                    print(f"{name:18} p50 {results[name]['p50_ms']}ms  p95 {results[name]['p95_ms']}ms  "
+                          f"p99 {results[name]['p99_ms']}ms  {results[name]['throughput_rps']}件/秒")
+        else:
+            statements = []
+            traced = _connect()
+            traced.set_trace_callback(statements.append)
+            _use_only_connection(traced)
+            app.config['JOB_RUNNER_ENABLED'] = False  # 計測中にジョブを実行しない
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = owner['user_id'] if owner else 0
+                sess['name'] = owner['name'] if owner else 'benchmark'
+                sess['role'] = 'owner'
+            
+            rng = random.Random(seed)
+            for name, method, path in selected:
+                latencies, queries, errors = [], [], 0
+                started = None
+                for n in range(warmup + count):
+                    if n == warmup:
+                        started = time.perf_counter()
+                    if no_cache:
+                        _dashboard_cache.clear()
+                        statistics_cache.entries.clear()
+                    url_path, data = _benchmark_request(rng, item_ids, cursor, method, path)
+                    statements.clear()
+                    request_started = time.perf_counter()
+                    response = client.open(url_path, method=method, data=data,
+                                           headers={'Accept': 'application/json'} if data else {})
+                    latency = time.perf_counter() - request_started
+                    response.close()
+                    if n < warmup:
+                        continue
+                    if response.status_code >= 400:
+                        errors += 1
+                    latencies.append(latency)
+                    queries.append(sum(1 for sql in statements if not sql.startswith(('BEGIN', 'COMMIT', 'ROLLBACK'))))
+                results[name] = _latency_summary(latencies, time.perf_counter() - started, queries, errors)
+                print(f"{name:18} p50 {results[name]['p50_ms']}ms  p95 {results[name]['p95_ms']}ms  "
+                      f"p99 {results[name]['p99_ms']}ms  {results[name]['throughput_rps']}件/秒  "
+                      f"SQL {results[name]['queries_per_request']}文")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    
+    report = {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'mode': 'gunicorn' if gunicorn_workers else ('http' if url else 'test_client'),
+        'database': app.config['DATABASE'],
+        'scale': scale,
+        'settings': {'requests': count, 'warmup': warmup, 'no_cache': no_cache, 'seed': seed,
+                     'concurrency': concurrency if url else 1, 'gunicorn_workers': gunicorn_workers},
+        'routes': results,
+    }
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'結果を {output} に保存しました')
+    
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            previous = json.load(f)['routes']
+        print('前回との比較（p95）:')
+        for name, summary in results.items():
+            before = previous.get(name, {}).get('p95_ms')
+            if before and summary['p95_ms'] is not None:
+                print(f"{name:18} {before}ms → {summary['p95_ms']}ms（{(summary['p95_ms'] / before - 1) * 100:+.1f}%）")
+
+# 静的ファイルのビルド（flask --app app build-assets）
+@app.cli.command('build-assets')
+def build_assets_command():
+    """CSS / JS を縮小・圧縮し、アイコンの縮小版とハッシュ付きファイル名の manifest を作る"""
+    if Image is None:
+        print('Pillow がインストールされていないため、アイコンの縮小版は作りません')
+    if brotli is None:
+        print('brotli がインストールされていないため、gzip のみ作成します')
+    manifest = build_assets()
+    for path, built in manifest['assets'].items():
+        print(f'{path} → {built}')
+    print(f'アイコン {len(manifest["icons"])}件の縮小版を作成しました')
+
+# クエリプランの確認（flask --app app check-query-plans）
+# 主要な画面を実際に表示して発行された SELECT を記録し、
+# 増え続けるテーブルを全件スキャンしているものがないか EXPLAIN QUERY PLAN で確認する。
+# （品目数ぶんのループでインデックスを引く ITEMS のスキャンは許容する）
+QUERY_PLAN_ROUTES = [
+    '/', '/trash', '/categories', '/add_item',
+    '/statistics', '/statistics?period=1year', '/statistics?month=2000-01',
+    '/history', '/history?cursor=2000-01-01 00:00:00|1', '/history?item_id=1&cursor=2000-01-01 00:00:00|1',
+    '/history?user_id=1', '/history?reason=使用', '/history?date_from=2000-01-01&date_to=2000-01-31',
+    '/history?month=2000-01', '/history?item_id=1&month=2000-01',
+]
+LARGE_TABLES = ('STOCK_TRANSACTIONS', 'STOCK_DAILY_ROLLUP', 'NOTIFICATIONS')
+
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_SQL_KEYWORDS = {'WHERE', 'JOIN', 'LEFT', 'INNER', 'ON', 'GROUP', 'ORDER', 'LIMIT', 'USING'}
+
+def _full_scans(conn, sql):
+    """インデックスを使わずに全件スキャンしているテーブル名の一覧を返す"""
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in _SQL_KEYWORDS:
+            aliases[alias] = table
+    scans = []
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+        detail = row['detail']
+        if detail.startswith('SCAN ') and 'USING' not in detail:
+            name = detail.split()[1]
+            scans.append(aliases.get(name, name))
+    return scans
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """主要画面のクエリが全件スキャンしていないか確認する"""
+    statements = []
+    traced = _connect()
+    traced.set_trace_callback(statements.append)
+    # プールに記録用の接続だけを置き、各リクエストで必ずそれが使われるようにする
+    _use_only_connection(traced)
+    app.config['JOB_RUNNER_ENABLED'] = False  # ジョブの SQL を記録しない
+    
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['name'] = 'check-query-plans'
+        sess['role'] = 'owner'
+    
+    conn = _connect()
+    failed = False
+    for path in QUERY_PLAN_ROUTES:
+        statements.clear()
+        client.get(path)
+        for sql in statements:
+            if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                continue
+            for table in _full_scans(conn, sql):
+                large = table in LARGE_TABLES
+                failed = failed or large
+                print(f"{'NG' if large else 'OK'} {path}: SCAN {table}")
+                print('    ' + ' '.join(sql.split())[:160])
+    conn.close()
+    
+    if failed:
+        raise SystemExit(1)
+    print('履歴・通知テーブルの全件スキャンはありません')
+
 if __name__ == '__main__':
     app.run(debug=True)
     
\ No newline at end of file
@@ -116,7 +116,7 @@ document.addEventListener('DOMContentLoaded', function() {
 document.addEventListener('DOMContentLoaded', function() {
     // 通知がある場合は通知エリアにスクロール
     const notifications = document.querySelector('.notifications');
-    if (notifications) {
+    if (notifications && notifications.querySelector('.notification-item')) {
         setTimeout(() => {
             notifications.scrollIntoView({ behavior: 'smooth', block: 'start' });
         }, 500);
@@ -194,4 +194,396 @@ document.addEventListener('DOMContentLoaded', function() {
         const categoryId = firstCategory.querySelector('.category-header').getAttribute('onclick').match(/\d+/)[0];
         toggleCategory(categoryId);
     }
-});
\ No newline at end of file
+});
+// ========================================
+// 履歴の「もっと見る」（ページ全体を読み直さずに続きを追加）
+// ========================================
+document.addEventListener('click', function(e) {
+    const link = e.target.closest('.load-more-link');
+    if (!link) {
+        return;
+    }
+    e.preventDefault();
+    
+    const container = link.closest('.load-more');
+    link.textContent = '読み込み中...';
+    
+    const url = new URL(link.href);
+    url.searchParams.set('partial', '1');
+    
+    fetch(url)
+        .then(response => response.text())
+        .then(html => {
+            // 「もっと見る」ボタンを次のページの内容で置き換える
+            container.insertAdjacentHTML('afterend', html);
+            container.remove();
+        })
+        .catch(() => {
+            link.textContent = 'もっと見る';
+        });
+});
+
+// ========================================
+// 他の端末での在庫変更を反映
+// （Server-Sent Events、無効なときは /api/inventory?since= の定期確認）
+// ========================================
+function formatQuantity(value) {
+    // サーバー側の表示（Python の float）に合わせて整数でも「.0」を付ける
+    return Number.isInteger(value) ? value.toFixed(1) : String(value);
+}
+
+function applyItemChange(item) {
+    const card = document.querySelector('.item-card[data-item-id="' + item.item_id + '"]');
+    if (!card) {
+        return;  // 新しく追加された品目は再読み込みで表示
+    }
+    if (item.deleted || item.is_active !== 1) {
+        card.remove();  // ゴミ箱に入れた・完全に削除した品目
+        return;
+    }
+    card.querySelector('.quantity-value').textContent = formatQuantity(item.current_quantity);
+    card.querySelector('.threshold-value').textContent = formatQuantity(item.min_threshold);
+    card.dataset.minThreshold = item.min_threshold;
+    card.classList.toggle('low-stock', item.current_quantity < item.min_threshold);
+}
+
+function applyNotificationChange(notification) {
+    const area = document.querySelector('.notifications');
+    const existing = area.querySelector('.notification-item[data-notification-id="' + notification.notification_id + '"]');
+    
+    if (notification.is_resolved) {
+        if (existing) {
+            existing.remove();
+        }
+    } else if (!existing) {
+        const element = document.createElement('div');
+        element.className = 'notification-item';
+        element.dataset.notificationId = notification.notification_id;
+        
+        const message = document.createElement('p');
+        const name = document.createElement('strong');
+        name.textContent = notification.item_name;
+        message.appendChild(name);
+        message.appendChild(document.createTextNode(
+            ' の在庫が少なくなっています（現在: ' + formatQuantity(notification.quantity_at_time) +
+            ' / 最低在庫数: ' + formatQuantity(notification.threshold_at_time) + '）'));
+        
+        const time = document.createElement('small');
+        time.textContent = notification.triggered_at;
+        
+        const link = document.createElement('a');
+        link.href = area.dataset.resolveUrl.replace(/0$/, notification.notification_id);
+        link.className = 'btn btn-small';
+        link.textContent = '解決';
+        link.addEventListener('click', function(e) {
+            if (!confirm('この通知を解決済みにしますか？')) {
+                e.preventDefault();
+            }
+        });
+        
+        element.append(message, time, link);
+        area.querySelector('h3').after(element);
+    }
+    
+    area.style.display = area.querySelector('.notification-item') ? '' : 'none';
+}
+
+function applyChanges(changes) {
+    changes.items.forEach(applyItemChange);
+    changes.notifications.forEach(applyNotificationChange);
+}
+
+function pollInventory(area) {
+    // ETag が前回と同じ（変更なし）なら 304 が返り、サーバーはデータベースを読まない
+    let since = area.dataset.since;
+    let etag = null;
+    const check = function() {
+        if (document.hidden) {
+            return;  // 表示していないタブでは確認しない
+        }
+        const url = new URL(area.dataset.inventoryUrl, location.href);
+        url.searchParams.set('since', since);
+        const headers = { 'Accept': 'application/json' };
+        if (etag) {
+            headers['If-None-Match'] = etag;
+        }
+        fetch(url, { headers: headers, cache: 'no-store' })
+            .then(response => {
+                if (response.status !== 200) {
+                    return;
+                }
+                etag = response.headers.get('ETag');
+                return response.json().then(changes => {
+                    applyChanges(changes);
+                    since = changes.version;
+                });
+            })
+            .catch(() => {});  // 通信できないときは次回に確認する
+    };
+    setInterval(check, Number(area.dataset.pollSeconds) * 1000);
+    document.addEventListener('visibilitychange', check);
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const area = document.querySelector('.notifications');
+    if (!area) {
+        return;  // 在庫一覧以外のページ
+    }
+    if (!area.dataset.eventsUrl || !window.EventSource) {
+        if (area.dataset.inventoryUrl) {
+            pollInventory(area);
+        }
+        return;
+    }
+    
+    const source = new EventSource(area.dataset.eventsUrl);
+    
+    source.addEventListener('changes', function(e) {
+        applyChanges(JSON.parse(e.data));
+    });
+    
+    // 変更が多すぎて取りこぼした場合はページ全体を読み直す
+    source.addEventListener('resync', function() {
+        location.reload();
+    });
+});
+
+// ========================================
+// 在庫更新・カテゴリー移動・削除をページ遷移なしで反映
+// （JavaScript が無効な場合は従来どおりフォーム送信→再表示）
+// ========================================
+function showMessage(message, category) {
+    const container = document.querySelector('main.container');
+    const alertBox = document.createElement('div');
+    alertBox.className = 'alert alert-' + category;
+    alertBox.textContent = message;
+    container.prepend(alertBox);
+    
+    setTimeout(() => {
+        alertBox.style.transition = 'opacity 0.5s';
+        alertBox.style.opacity = '0';
+        setTimeout(() => alertBox.remove(), 500);
+    }, 3000);
+}
+
+function submitWithFetch(form) {
+    return fetch(form.action, {
+        method: 'POST',
+        body: new FormData(form),
+        headers: { 'Accept': 'application/json' }
+    }).then(response => {
+        const type = response.headers.get('Content-Type') || '';
+        if (!type.includes('application/json')) {
+            throw new Error('unexpected response');
+        }
+        return response.json();
+    });
+}
+
+function updateItemCount(section) {
+    const count = section.querySelectorAll('.item-card').length;
+    section.querySelector('.item-count').textContent = '(' + count + '品目)';
+}
+
+function moveItemCard(card, oldCategoryId, newCategoryId) {
+    const target = document.getElementById('content-' + newCategoryId);
+    if (!target) {
+        location.reload();  // 移動先のカテゴリーがまだ表示されていない
+        return;
+    }
+    const oldSection = card.closest('.category-accordion');
+    target.querySelector('.items-grid').appendChild(card);
+    updateItemCount(oldSection);
+    updateItemCount(target.closest('.category-accordion'));
+    
+    // 「カテゴリー移動」の選択肢を移動先に合わせて入れ替える
+    const select = card.querySelector('select[name="category_id"]');
+    select.querySelector('option[value="' + newCategoryId + '"]').remove();
+    const option = document.createElement('option');
+    option.value = oldCategoryId;
+    option.textContent = '→ ' + oldSection.querySelector('.category-header-title').textContent;
+    select.appendChild(option);
+    select.value = '';
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (!window.fetch) {
+        return;
+    }
+    
+    // 在庫の増減
+    document.querySelectorAll('.stock-form').forEach(form => {
+        form.addEventListener('submit', function(e) {
+            if (e.defaultPrevented) {
+                return;  // 入力チェックで止められた
+            }
+            e.preventDefault();
+            
+            submitWithFetch(form).then(data => {
+                if (!data.ok) {
+                    showMessage(data.message, 'error');
+                    return;
+                }
+                applyItemChange(data.item);
+                data.notifications.forEach(applyNotificationChange);
+                form.querySelector('input[name="quantity_delta"]').value = '';
+                form.querySelector('input[name="note"]').value = '';
+                showMessage(data.message, 'success');
+            }).catch(() => form.submit());
+        });
+    });
+    
+    // カテゴリー移動
+    document.querySelectorAll('.category-change-form').forEach(form => {
+        form.addEventListener('submit', function(e) {
+            e.preventDefault();
+            const card = form.closest('.item-card');
+            const oldCategoryId = card.closest('.category-content').id.replace('content-', '');
+            
+            submitWithFetch(form).then(data => {
+                showMessage(data.message, data.ok ? 'success' : 'error');
+                if (data.ok) {
+                    moveItemCard(card, oldCategoryId, data.category_id);
+                }
+            }).catch(() => form.submit());
+        });
+    });
+    
+    // 削除
+    document.querySelectorAll('.delete-form').forEach(form => {
+        form.addEventListener('submit', function(e) {
+            if (e.defaultPrevented) {
+                return;  // 確認ダイアログでキャンセルされた
+            }
+            e.preventDefault();
+            const card = form.closest('.item-card');
+            
+            submitWithFetch(form).then(data => {
+                showMessage(data.message, data.ok ? 'success' : 'error');
+                if (data.ok) {
+                    const section = card.closest('.category-accordion');
+                    card.remove();
+                    updateItemCount(section);
+                }
+            }).catch(() => form.submit());
+        });
+    });
+});
+
+// ========================================
+// ジョブ一覧の自動更新
+// ========================================
+document.addEventListener('DOMContentLoaded', function() {
+    // 待機中・実行中のジョブがある間は数秒ごとに読み直して進捗を表示する
+    if (document.querySelector('[data-jobs-active]')) {
+        setTimeout(() => location.reload(), 3000);
+    }
+});
+
+// ========================================
+// 品目の検索（入力が止まってから問い合わせ、一致した品目だけを表示）
+// ========================================
+const SEARCH_DELAY_MS = 200;
+
+function showSearchResults(list, items) {
+    list.replaceChildren();
+    if (items.length === 0) {
+        const empty = document.createElement('li');
+        empty.className = 'search-empty';
+        empty.textContent = '見つかりませんでした';
+        list.appendChild(empty);
+    }
+    items.forEach(item => {
+        const entry = document.createElement('li');
+        entry.className = 'search-result' + (item.current_quantity < item.min_threshold ? ' low-stock' : '');
+        entry.dataset.itemId = item.item_id;
+        entry.dataset.categoryId = item.category_id;
+        
+        const name = document.createElement('strong');
+        name.textContent = item.name;
+        const detail = document.createElement('span');
+        detail.textContent = formatQuantity(item.current_quantity) + ' ' + (item.unit || '') +
+            (item.category_name ? '・' + item.category_name : '');
+        
+        entry.append(name, detail);
+        list.appendChild(entry);
+    });
+    list.hidden = false;
+}
+
+function jumpToItem(entry) {
+    const card = document.querySelector('.item-card[data-item-id="' + entry.dataset.itemId + '"]');
+    if (!card) {
+        return;
+    }
+    const content = card.closest('.category-content');
+    if (content && content.style.display === 'none') {
+        toggleCategory(entry.dataset.categoryId);
+    }
+    card.scrollIntoView({ behavior: 'smooth', block: 'center' });
+    card.classList.add('search-hit');
+    setTimeout(() => card.classList.remove('search-hit'), 2000);
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const box = document.querySelector('.item-search');
+    if (!box) {
+        return;
+    }
+    const input = box.querySelector('.item-search-input');
+    const list = box.querySelector('.search-results');
+    let timer = null;
+    let controller = null;
+    
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const query = input.value.trim();
+        if (!query) {
+            if (controller) {
+                controller.abort();
+            }
+            list.hidden = true;
+            return;
+        }
+        timer = setTimeout(() => {
+            // 前の問い合わせの結果が後から届いて上書きしないよう中断する
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            const url = new URL(box.dataset.searchUrl, location.href);
+            url.searchParams.set('q', query);
+            fetch(url, { signal: controller.signal, headers: { 'Accept': 'application/json' } })
+                .then(response => response.json())
+                .then(data => showSearchResults(list, data.items))
+                .catch(() => {});
+        }, SEARCH_DELAY_MS);
+    });
+    
+    input.addEventListener('keydown', function(e) {
+        if (e.key === 'Enter') {
+            e.preventDefault();
+            const first = list.querySelector('.search-result');
+            if (first) {
+                jumpToItem(first);
+            }
+        } else if (e.key === 'Escape') {
+            input.value = '';
+            list.hidden = true;
+        }
+    });
+    
+    list.addEventListener('click', function(e) {
+        const entry = e.target.closest('.search-result');
+        if (entry) {
+            jumpToItem(entry);
+        }
+    });
+    
+    // 検索欄の外をクリックしたら結果を閉じる
+    document.addEventListener('click', function(e) {
+        if (!box.contains(e.target)) {
+            list.hidden = true;
+        }
+    });
+});